@@ -7,13 +7,14 @@ from datetime import datetime
 import azure.functions as func
 import logging
 import json
-import tempfile
 
 from wx_explore.common import tracing
+from wx_explore.common.config import Config
 from wx_explore.common.logging import init_sentry
 from wx_explore.common.models import Source
 from wx_explore.common.tracing import init_tracing
-from wx_explore.ingest.grib import reduce_grib, ingest_grib_file
+from wx_explore.ingest.grib import stream_grib_messages, ingest_grib_messages
+from wx_explore.ingest.grib_decode import GribDecoder
 from wx_explore.web.core import db
 
 logger = logging.getLogger(__name__)
@@ -36,13 +37,12 @@ def main(msg: func.QueueMessage):
             try:
                 source = Source.query.filter_by(short_name=ingest_req['source']).first()
 
-                with tempfile.NamedTemporaryFile() as reduced:
-                    with tracing.start_span('download'):
-                        logging.info(f"Downloading and reducing {ingest_req['url']} from {ingest_req['run_time']} {source.short_name}")
-                        reduce_grib(ingest_req['url'], ingest_req['idx_url'], source.fields, reduced)
-                    with tracing.start_span('ingest'):
-                        logging.info("Ingesting all")
-                        ingest_grib_file(reduced.name, source)
+                # Messages are decoded and ingested as they're downloaded
+                with tracing.start_span('download and ingest'):
+                    logging.info(f"Downloading and ingesting {ingest_req['url']} from {ingest_req['run_time']} {source.short_name}")
+                    msgs = stream_grib_messages(ingest_req['url'], ingest_req['idx_url'], source.fields)
+                    with GribDecoder(Config.GRIB_DECODE_WORKERS) as decoder:
+                        ingest_grib_messages(msgs, source, decoder=decoder)
 
                 source.last_updated = datetime.utcnow()
 
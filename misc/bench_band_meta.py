@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Compares the old (unpartitioned, PK only) file_band_meta layout against the partitioned one in
+models.FileBandMeta, using EXPLAIN ANALYZE of the queries which hit the table:
+  * finding bands by source field and valid time range (band lookups)
+  * finding files with upcoming data (merge planning)
+  * only keeping the newest run of past data (clean)
+  * expiring a day of data (clean): DELETE vs dropping the day's partition
+
+Both tables are created in a scratch schema (dropped afterwards) and filled with the same ~1M rows:
+50 source fields, hourly valid times over 30 days, and 28 runs of each.
+
+Usage: misc/bench_band_meta.py POSTGRES_DSN [-v]
+"""
+import datetime
+import sys
+import time
+
+import psycopg2
+
+SCHEMA = 'bench_band_meta'
+N_FIELDS = 50
+N_DAYS = 30
+N_RUNS = 28
+START = datetime.datetime(2021, 1, 1)
+
+COLUMNS = """
+    file_name varchar NOT NULL,
+    "offset" integer NOT NULL,
+    vals_per_loc integer,
+    encoding varchar(8),
+    scale float,
+    add_offset float,
+    source_field_id integer,
+    valid_time timestamp NOT NULL,
+    run_time timestamp
+"""
+
+FILL = f"""
+    INSERT INTO {{table}}
+    SELECT
+        md5(run::text || '-' || (hour / 6)::text),
+        sf * 4 + (hour % 6) * {N_FIELDS} * 4,
+        1, NULL, NULL, NULL,
+        sf,
+        %(start)s::timestamp + hour * interval '1 hour',
+        %(start)s::timestamp + (hour - run) * interval '1 hour'
+    FROM generate_series(0, {N_FIELDS - 1}) sf,
+         generate_series(0, {N_DAYS * 24 - 1}) hour,
+         generate_series(0, {N_RUNS - 1}) run
+"""
+
+
+def setup(cur):
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+
+    cur.execute(f"CREATE TABLE {SCHEMA}.flat ({COLUMNS}, PRIMARY KEY (file_name, \"offset\"))")
+
+    cur.execute(f"CREATE TABLE {SCHEMA}.part ({COLUMNS}, PRIMARY KEY (file_name, \"offset\", valid_time)) PARTITION BY RANGE (valid_time)")
+    cur.execute(f"CREATE TABLE {SCHEMA}.part_default PARTITION OF {SCHEMA}.part DEFAULT")
+    for day in range(N_DAYS):
+        lo = START + datetime.timedelta(days=day)
+        hi = lo + datetime.timedelta(days=1)
+        cur.execute(f"CREATE TABLE {SCHEMA}.part_{day} PARTITION OF {SCHEMA}.part FOR VALUES FROM (%s) TO (%s)", (lo, hi))
+    cur.execute(
+        f"CREATE INDEX part_field_time_idx ON {SCHEMA}.part (source_field_id, valid_time) "
+        f"INCLUDE (\"offset\", vals_per_loc, run_time, file_name)"
+    )
+
+    for table in ('flat', 'part'):
+        cur.execute(FILL.format(table=f"{SCHEMA}.{table}"), {'start': START})
+        cur.execute(f"VACUUM ANALYZE {SCHEMA}.{table}")
+
+
+def explain(cur, sql, params, verbose):
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+    plan = [row for row, in cur.fetchall()]
+    if verbose:
+        print('\n'.join('    ' + line for line in plan))
+
+    buffers = next((line.strip() for line in plan if line.strip().startswith('Buffers:')), '')
+    return plan[0].strip(), buffers
+
+
+def best_time(cur, sql, params, n=5):
+    times = []
+    for _ in range(n):
+        cur.execute("BEGIN")
+        start = time.monotonic()
+        cur.execute(sql, params)
+        times.append(time.monotonic() - start)
+        cur.execute("ROLLBACK")
+    return min(times)
+
+
+def main():
+    dsn = sys.argv[1]
+    verbose = '-v' in sys.argv[2:]
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    print("Creating tables...")
+    setup(cur)
+    cur.execute(f"SELECT count(*) FROM {SCHEMA}.flat")
+    print(f"{cur.fetchone()[0]} rows per table")
+
+    now = START + datetime.timedelta(days=N_DAYS // 2)
+    cases = [
+        (
+            "band lookup",
+            "SELECT file_name, \"offset\", vals_per_loc, run_time FROM {table} "
+            "WHERE source_field_id IN (1, 2, 3, 4, 5) AND valid_time >= %(start)s AND valid_time < %(end)s",
+            {'start': now, 'end': now + datetime.timedelta(days=2)},
+            None,
+        ),
+        (
+            "merge scan",
+            "SELECT DISTINCT file_name FROM {table} WHERE valid_time > %(now)s",
+            {'now': now},
+            None,
+        ),
+        (
+            "keep newest run",
+            "DELETE FROM {table} t WHERE valid_time < %(now)s AND EXISTS ("
+            "SELECT 1 FROM {table} n WHERE n.source_field_id = t.source_field_id AND n.valid_time = t.valid_time AND n.run_time > t.run_time)",
+            {'now': now},
+            None,
+        ),
+        (
+            "expire a day",
+            "DELETE FROM {table} WHERE valid_time < %(end)s",
+            {'end': START + datetime.timedelta(days=1)},
+            f"DROP TABLE {SCHEMA}.part_0",
+        ),
+    ]
+
+    print(f"{'query':>16} {'layout':>6} {'ms':>9}  plan / buffers")
+    for name, sql, params, part_sql in cases:
+        for table in ('flat', 'part'):
+            if table == 'part' and part_sql is not None:
+                query, query_params = part_sql, {}
+                summary = (part_sql, '')
+            else:
+                query, query_params = sql.format(table=f"{SCHEMA}.{table}"), params
+                cur.execute("BEGIN")
+                summary = explain(cur, query, query_params, verbose)
+                cur.execute("ROLLBACK")
+
+            t = best_time(cur, query, query_params)
+            print(f"{name:>16} {table:>6} {t*1e3:>9.1f}  {summary[0]}")
+            if summary[1]:
+                print(f"{'':>34}{summary[1]}")
+
+    cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+
+
+if __name__ == "__main__":
+    main()
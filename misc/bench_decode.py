@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of decoding band values out of the location chunks of (merged) file groups.
+
+Times the shipped StripedBackend._decode_fields (which decodes through encoding.Decoder) against
+decode_baseline, a copy of the decode it replaced (slicing every band out of its chunk and joining
+the bytes, for every location), on the same float32 bands and chunks.
+
+This needs the same environment as the web app (the storage package imports the DB models).
+
+Usage: misc/bench_decode.py [NUM_BANDS ...]
+"""
+import datetime
+import sys
+import timeit
+import types
+
+import numpy
+
+from wx_explore.common.models import DataPointBatch
+from wx_explore.common.storage import encoding
+from wx_explore.common.storage.band_index import Band, BandFile
+from wx_explore.common.storage.stripes import StripedBackend
+
+N_FILES = 4
+N_LOCS = 50
+START = datetime.datetime(2021, 1, 1)
+
+
+def make_query(n_bands):
+    """
+    :return: (bands, source fields, reads, read results, locs) as passed to StripedBackend._decode_fields
+    """
+    # Mostly single-valued bands, with the occasional ensemble-ish one
+    vals_per_loc = [3 if i % 10 == 0 else 1 for i in range(n_bands)]
+
+    file_bands = [[] for _ in range(N_FILES)]
+    for i, n in enumerate(vals_per_loc):
+        file_bands[i % N_FILES].append((i, n))
+
+    locs = [(x, 0) for x in range(N_LOCS)]
+    bands = []
+    reads = []
+    results = []
+    for f, fbands in enumerate(file_bands):
+        loc_size = sum(encoding.value_size(encoding.F4, n) for _, n in fbands)
+        band_file = BandFile(f"file{f}", loc_size, None, N_LOCS)
+
+        offset = 0
+        for i, n in fbands:
+            bands.append(Band(
+                band_file, offset, n, encoding.F4, None, None,
+                i, START + datetime.timedelta(hours=i), START,
+            ))
+            offset += encoding.value_size(encoding.F4, n)
+
+        reads.append((band_file, 0, set(x for x, _ in locs)))
+        results.append({x: numpy.random.random(loc_size // 4).astype(numpy.float32).tobytes() for x, _ in locs})
+
+    # Bands are used in a different order than they are stored in
+    bands = [bands[i] for i in numpy.random.permutation(len(bands))]
+    source_fields = [types.SimpleNamespace(id=i, metric_id=i % 7) for i in range(n_bands)]
+
+    return bands, source_fields, reads, results, locs
+
+
+def decode_baseline(bands, valid_source_fields, reads, results, locs):
+    """
+    Reference: StripedBackend._decode_fields as it was before decoding was vectorized
+    """
+    metric_ids = {sf.id: sf.metric_id for sf in valid_source_fields}
+
+    file_contents = {}
+    for (fm, y, _), chunks in zip(reads, results):
+        for x, content in chunks.items():
+            file_contents[(fm.file_name, x, y)] = memoryview(content)
+
+    valid_time = numpy.array([band.valid_time for band in bands], dtype='datetime64[us]')
+    metric_id = numpy.array([metric_ids[band.source_field_id] for band in bands], dtype=numpy.int64)
+    source_field_id = numpy.array([band.source_field_id for band in bands], dtype=numpy.int64)
+    run_time = numpy.array([band.run_time for band in bands], dtype='datetime64[us]')
+    offsets = numpy.concatenate([[0], numpy.cumsum([band.vals_per_loc for band in bands], dtype=numpy.int64)])
+
+    batches = []
+    for x, y in locs:
+        raw = b''.join(
+            file_contents[(band.file.file_name, x, y)][band.offset:band.offset+(4*band.vals_per_loc)]
+            for band in bands
+        )
+
+        batches.append(DataPointBatch(
+            valid_time=valid_time,
+            metric_id=metric_id,
+            values=numpy.frombuffer(raw, dtype=numpy.float32),
+            offsets=offsets,
+            source_field_id=source_field_id,
+            run_time=run_time,
+        ))
+
+    return batches
+
+
+def best_time(f):
+    timer = timeit.Timer(f)
+    n, _ = timer.autorange()
+    return min(timer.repeat(5, n)) / n
+
+
+def main():
+    band_counts = [int(n) for n in sys.argv[1:]] or [10, 100, 500, 2000]
+
+    print(f"{N_LOCS} locations per query, bands spread over {N_FILES} files")
+    print(f"{'bands':>8} {'baseline (ns/band/loc)':>24} {'shipped (ns/band/loc)':>23} {'speedup':>8}")
+
+    for n_bands in band_counts:
+        query = make_query(n_bands)
+
+        # Sanity check both decode the same thing
+        for old, new in zip(decode_baseline(*query), StripedBackend._decode_fields(*query)):
+            assert numpy.array_equal(old.values, new.values)
+            assert numpy.array_equal(old.offsets, new.offsets)
+
+        # Both include the per-query setup, the same way a request would
+        baseline = best_time(lambda: decode_baseline(*query)) / n_bands / N_LOCS * 1e9
+        shipped = best_time(lambda: StripedBackend._decode_fields(*query)) / n_bands / N_LOCS * 1e9
+
+        print(f"{n_bands:>8} {baseline:>24.1f} {shipped:>23.1f} {baseline / shipped:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
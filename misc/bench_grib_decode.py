@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Times unpacking the values of every message in a GRIB file with GribDecoder, in-process
+(1 worker) and with pools of worker processes.
+
+Each pool is timed twice: cold (including starting its worker processes, as the first
+group an ingest worker ingests would see), and warm.
+
+Usage: misc/bench_grib_decode.py GRIB_FILE [WORKERS ...]
+"""
+import os
+import sys
+import time
+
+import numpy
+import pygrib
+
+from wx_explore.ingest.grib_decode import GribDecoder
+
+
+def decode_all(decoder, msgs):
+    futures = [decoder.submit(msg) for msg in msgs]
+    return [fut.result() for fut in futures]
+
+
+def main():
+    grib_path = sys.argv[1]
+    worker_counts = [int(n) for n in sys.argv[2:]] or sorted(set([2, 4, os.cpu_count() or 1]))
+
+    grib = pygrib.open(grib_path)
+    msgs = grib.read()
+    grib.close()
+
+    with GribDecoder(1) as decoder:
+        start = time.monotonic()
+        expected = decode_all(decoder, msgs)
+        serial = time.monotonic() - start
+
+    n_bytes = sum(vals.nbytes for vals in expected)
+    print(f"{len(msgs)} messages, {n_bytes / 1024 / 1024:.0f} MB of float32 values, {os.cpu_count()} cores")
+
+    print(f"{'workers':>8} {'cold s':>8} {'warm s':>8} {'speedup (warm)':>15}")
+    print(f"{1:>8} {serial:>8.2f} {serial:>8.2f} {1:>14.1f}x")
+
+    for workers in worker_counts:
+        with GribDecoder(workers) as decoder:
+            start = time.monotonic()
+            values = decode_all(decoder, msgs)
+            cold = time.monotonic() - start
+
+            start = time.monotonic()
+            decode_all(decoder, msgs)
+            warm = time.monotonic() - start
+
+        assert all(numpy.array_equal(a, b, equal_nan=True) for a, b in zip(expected, values))
+
+        print(f"{workers:>8} {cold:>8.2f} {warm:>8.2f} {serial / warm:>14.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Measures peak RSS and time of building and writing a file group with the shipped
+StripedBackend.put_fields (including encoding.encode), against build_baseline, a copy of the
+builder it replaced (per-band float32 copies -> numpy.stack -> per-row tobytes()).
+
+put_fields is run on a backend which reads every byte of each row it's given (as an upload
+would) and then drops it. Its DB calls (FileMeta/FileBandMeta rows, source field encodings,
+partitions, notifications) are replaced with stand-ins, so nothing is written to the DB, but this
+still needs the same environment as the ingester to import. Each builder is run in a fresh process so
+ru_maxrss only covers that builder.
+
+Usage: misc/bench_put_fields.py [--encoding ENCODING] [NUM_BANDS ...]
+"""
+import argparse
+import concurrent.futures
+import datetime
+import resource
+import subprocess
+import sys
+import time
+import types
+
+import numpy
+
+from wx_explore.common.storage import encoding, stripes
+
+# HRRR CONUS grid
+N_Y, N_X = 1059, 1799
+START = datetime.datetime(2021, 1, 1)
+
+
+class DiscardBackend(stripes.StripedBackend):
+    def __init__(self):
+        super().__init__(band_index=object())
+
+    def _write_stripe(self, y, file_name, data):
+        # Stand-in for an upload, which needs to read every byte
+        bytes(data)
+
+
+def stub_db(field_encoding):
+    """
+    Replace everything put_fields does with the DB with stand-ins
+    """
+    class Query(object):
+        def filter(self, ids):
+            self.ids = ids
+            return self
+
+        def all(self):
+            return [types.SimpleNamespace(id=i, metric=types.SimpleNamespace(encoding=field_encoding)) for i in self.ids]
+
+    class Insert(object):
+        def values(self, _):
+            return self
+
+        def on_conflict_do_nothing(self):
+            return self
+
+    stripes.SourceField = types.SimpleNamespace(query=Query(), id=types.SimpleNamespace(in_=lambda ids: ids))
+    stripes.FileMeta = types.SimpleNamespace
+    stripes.insert = lambda _: Insert()
+    stripes.notify_bands_changed = lambda *_: None
+    stripes.ensure_band_partitions = lambda *_: []
+    stripes.db = types.SimpleNamespace(session=types.SimpleNamespace(
+        add=lambda _: None,
+        commit=lambda: None,
+        execute=lambda _: None,
+    ))
+
+
+def make_fields(n_bands):
+    # Values come out of pygrib as float64
+    return {
+        (i, START + datetime.timedelta(hours=i), START): [numpy.random.random((N_Y, N_X))]
+        for i in range(n_bands)
+    }
+
+
+def build_baseline(fields):
+    """
+    Reference: the file group builder put_fields used before building in place
+    """
+    vals = [msg.astype(numpy.float32) for msgs in fields.values() for msg in msgs]
+    combined = numpy.stack(vals, axis=-1)
+
+    backend = DiscardBackend()
+    with concurrent.futures.ThreadPoolExecutor(backend.write_workers) as executor:
+        concurrent.futures.wait([executor.submit(backend._write_stripe, y, 'baseline', row.tobytes()) for y, row in enumerate(combined)])
+
+
+def build_shipped(fields):
+    proj = types.SimpleNamespace(id=1, shape=lambda: (N_Y, N_X))
+    DiscardBackend().put_fields(proj, fields)
+
+
+def run_one(builder, field_encoding, n_bands):
+    stub_db(field_encoding)
+    fields = make_fields(n_bands)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.monotonic()
+    {'baseline': build_baseline, 'shipped': build_shipped}[builder](fields)
+    elapsed = time.monotonic() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux
+    print(f"{(peak - base) / 1024:.0f} {elapsed:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--encoding', default=encoding.F4, choices=encoding.ENCODINGS)
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('n_bands', nargs='*', type=int, default=[20, 50, 100])
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(args.run, args.encoding, args.n_bands[0])
+        return
+
+    print(f"Encoding: {args.encoding} (baseline is always f4)")
+    print(f"{'bands':>6} {'input MB':>9} {'baseline peak MB':>17} {'shipped peak MB':>16} {'baseline s':>11} {'shipped s':>10}")
+
+    for n_bands in args.n_bands:
+        results = {}
+        for builder in ('baseline', 'shipped'):
+            out = subprocess.run(
+                [sys.executable, __file__, '--run', builder, '--encoding', args.encoding, str(n_bands)],
+                check=True, capture_output=True, text=True,
+            )
+            results[builder] = [float(v) for v in out.stdout.split()]
+
+        input_mb = N_Y * N_X * 8 * n_bands / 1024 / 1024
+        print(
+            f"{n_bands:>6} {input_mb:>9.0f} {results['baseline'][0]:>17.0f} {results['shipped'][0]:>16.0f} "
+            f"{results['baseline'][1]:>11.2f} {results['shipped'][1]:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
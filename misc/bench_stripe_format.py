@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compares the raw stripe layout against the blocked (compressed) layout from
+wx_explore.common.storage.stripe_format for a synthetic HRRR-like row.
+
+Reports, per block size:
+  * bytes stored per row
+  * bytes read for a single point query (with and without the row header cached)
+  * time to decode one location chunk out of what was read
+  * time to encode a row (paid once, at ingest/merge time)
+
+Fields are generated as smooth random surfaces quantized to the precision GRIB packing
+typically keeps, since random noise doesn't compress and isn't representative.
+
+Usage: misc/bench_stripe_format.py [NUM_BANDS [BLOCK_SIZE ...]]
+"""
+import os
+import sys
+import timeit
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wx_explore', 'common', 'storage'))
+import stripe_format  # noqa: E402
+
+# HRRR CONUS grid width
+N_X = 1799
+
+
+def make_row(n_bands):
+    rng = numpy.random.default_rng(0)
+    bands = []
+    for _ in range(n_bands):
+        scale = 10 ** rng.integers(0, 4)
+        # Random walk along the row, quantized to ~3 significant digits
+        surface = numpy.cumsum(rng.normal(0, scale / 100, N_X)) + rng.uniform(-scale, scale)
+        bands.append(numpy.round(surface / scale, 3) * scale)
+    return numpy.ascontiguousarray(numpy.stack(bands, axis=-1), dtype=numpy.float32)
+
+
+def best_time(f):
+    timer = timeit.Timer(f)
+    n, _ = timer.autorange()
+    return min(timer.repeat(5, n)) / n
+
+
+def main():
+    n_bands = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    block_sizes = [int(n) for n in sys.argv[2:]] or [16, 64, 256]
+
+    # Location chunks, as stored
+    row = make_row(n_bands).view(numpy.uint8)
+    loc_size = row.shape[1]
+    raw = row.tobytes()
+    x = N_X // 2
+
+    raw_decode = best_time(lambda: numpy.frombuffer(raw[x*loc_size:(x+1)*loc_size], dtype=numpy.float32))
+
+    print(f"{n_bands} bands, {N_X} locations per row")
+    print(f"{'layout':>10} {'stored B/row':>13} {'ratio':>6} {'read B/query':>13} {'(header cached)':>16} {'decode us':>10} {'encode ms/row':>14}")
+    print(f"{'raw':>10} {len(raw):>13} {1:>6.2f} {loc_size:>13} {loc_size:>16} {raw_decode*1e6:>10.1f} {0:>14.1f}")
+
+    for block_size in block_sizes:
+        encoded = stripe_format.encode_stripe(row, block_size)
+        assert (stripe_format.decode_stripe(encoded, N_X, block_size, loc_size) == row).all()
+
+        header = stripe_format.parse_header(encoded, N_X, block_size)
+        sizes = numpy.diff(header)
+        block = x // block_size
+        block_data = encoded[header[block]:header[block+1]]
+
+        decode = best_time(lambda: stripe_format.decode_block(block_data, loc_size)[x - block * block_size].tobytes())
+        encode = best_time(lambda: stripe_format.encode_stripe(row, block_size))
+
+        header_bytes = stripe_format.header_size(N_X, block_size)
+        mean_block = sizes.mean()
+        print(
+            f"{'b' + str(block_size):>10} {len(encoded):>13} {len(raw) / len(encoded):>6.2f} "
+            f"{header_bytes + mean_block:>13.0f} {mean_block:>16.0f} {decode*1e6:>10.1f} {encode*1e3:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Adds per-metric band encodings (see storage.encoding) to an existing database: the metric.encoding
+and file_band_meta.encoding/scale/add_offset columns, and the encoding of every metric in
+common.metrics. Existing bands are all float32, which is what NULL means.
+
+Safe to run more than once. Run before misc/migrate_partition_file_band_meta.py.
+
+Usage: misc/migrate_band_encodings.py
+"""
+import logging
+import os
+import sys
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wx_explore.web.core import app, db  # noqa: E402
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    with app.app_context():
+        db.session.execute(text("ALTER TABLE metric ADD COLUMN IF NOT EXISTS encoding varchar(8)"))
+        db.session.execute(text(
+            "ALTER TABLE file_band_meta "
+            "ADD COLUMN IF NOT EXISTS encoding varchar(8), "
+            "ADD COLUMN IF NOT EXISTS scale double precision, "
+            "ADD COLUMN IF NOT EXISTS add_offset double precision"
+        ))
+        db.session.commit()
+
+    # Updates the encoding of every existing metric (and needs the columns above to exist)
+    from wx_explore.common import metrics
+    for metric in metrics.ALL_METRICS:
+        logging.info("%s: %s", metric.name, metric.encoding or 'f4')
+
+    logging.info("Done")
+
+
+if __name__ == "__main__":
+    main()
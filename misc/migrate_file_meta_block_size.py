@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Adds file_meta.block_size (see models.FileMeta and storage.stripe_format) to an existing database.
+Existing file groups are all raw, which is what NULL means, so nothing else needs to change.
+
+Safe to run more than once.
+
+Usage: misc/migrate_file_meta_block_size.py
+"""
+import logging
+import os
+import sys
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wx_explore.web.core import app, db  # noqa: E402
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    with app.app_context():
+        db.session.execute(text("ALTER TABLE file_meta ADD COLUMN IF NOT EXISTS block_size integer"))
+        db.session.commit()
+
+        logging.info("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Migrates an existing (unpartitioned) file_band_meta table to the partitioned layout in models.FileBandMeta.
+
+Everything happens in a single transaction, so on any error nothing changes. Stop ingest, merge and
+clean while this runs; queries can keep running (they read from the in-memory band index, which is
+reloaded once the migration commits).
+
+Usage: misc/migrate_partition_file_band_meta.py
+"""
+import datetime
+import logging
+import os
+import sys
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wx_explore.common.config import Config  # noqa: E402
+from wx_explore.common.db_utils import ensure_band_partitions  # noqa: E402
+from wx_explore.common.models import FileBandMeta  # noqa: E402
+from wx_explore.common.storage.band_index import notify_bands_changed  # noqa: E402
+from wx_explore.web.core import app, db  # noqa: E402
+
+OLD_TABLE = 'file_band_meta_unpartitioned'
+COLUMNS = ', '.join(f'"{col.name}"' for col in FileBandMeta.__table__.columns)
+
+
+def is_partitioned():
+    return db.session.execute(text(
+        "SELECT count(*) FROM pg_partitioned_table JOIN pg_class ON partrelid = pg_class.oid WHERE relname = :name"
+    ), {'name': FileBandMeta.__tablename__}).scalar() > 0
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    with app.app_context():
+        if is_partitioned():
+            logging.info("%s is already partitioned", FileBandMeta.__tablename__)
+            return
+
+        # Move the old table (and its PK index, whose name the new table needs) out of the way
+        db.session.execute(text(f"LOCK TABLE {FileBandMeta.__tablename__} IN EXCLUSIVE MODE"))
+        db.session.execute(text(f"ALTER TABLE {FileBandMeta.__tablename__} RENAME TO {OLD_TABLE}"))
+        db.session.execute(text(f"ALTER TABLE {OLD_TABLE} RENAME CONSTRAINT {FileBandMeta.__tablename__}_pkey TO {OLD_TABLE}_pkey"))
+
+        FileBandMeta.__table__.create(db.session.connection())
+
+        start, end = db.session.execute(text(f"SELECT min(valid_time), max(valid_time) FROM {OLD_TABLE}")).one()
+        now = datetime.datetime.utcnow()
+        created = ensure_band_partitions(
+            min(start or now, now),
+            max(end or now, now + datetime.timedelta(days=Config.BAND_PARTITION_DAYS_AHEAD)),
+        )
+        logging.info("Created %d partitions", len(created))
+
+        # valid_time is now part of the PK, so can't be NULL (nothing could query those bands anyways)
+        inserted = db.session.execute(text(
+            f"INSERT INTO {FileBandMeta.__tablename__} ({COLUMNS}) SELECT {COLUMNS} FROM {OLD_TABLE} WHERE valid_time IS NOT NULL"
+        )).rowcount
+        logging.info("Copied %d bands", inserted)
+
+        db.session.execute(text(f"DROP TABLE {OLD_TABLE}"))
+        notify_bands_changed()
+        db.session.commit()
+
+        db.session.execute(text(f"ANALYZE {FileBandMeta.__tablename__}"))
+        db.session.commit()
+
+        logging.info("Done")
+
+
+if __name__ == "__main__":
+    main()
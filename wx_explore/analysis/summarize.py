@@ -1,4 +1,4 @@
-from typing import List, Iterable, Dict, Tuple, Optional, Mapping, Any
+from typing import List, Iterable, Dict, NamedTuple, Tuple, Optional, Mapping, Any, Union
 
 import datetime
 import math
@@ -6,40 +6,49 @@ import numpy
 import itertools
 
 from wx_explore.analysis.helpers import (
-    get_metric,
     group_by_time,
 )
 from wx_explore.common import metrics
 from wx_explore.common.models import (
     Metric,
     DataPointSet,
+    DataPointBatch,
 )
 from wx_explore.common.utils import (
     RangeDict,
     ContinuousTimeList,
+    datetime2numpy,
 )
 
 
-def combine_models(model_data: Iterable[DataPointSet]) -> List[DataPointSet]:
+def combine_models(model_data: Union[DataPointBatch, Iterable[DataPointSet]]) -> DataPointBatch:
     """
-    Group data from all models in loc_data by metric, returning one DataPointSet
-    for each metric.
+    Group data from all models in loc_data by metric, returning one data point
+    for each (metric, valid_time).
     """
-    combined_sets: Dict[Tuple[int, datetime.datetime], DataPointSet] = {}
-
-    for model_data_point in model_data:
-        metric = get_metric(model_data_point.source_field_id)
-        if (metric.id, model_data_point.valid_time) not in combined_sets:
-            combined_sets[(metric.id, model_data_point.valid_time)] = DataPointSet(
-                values=[],
-                metric_id=metric.id,
-                valid_time=model_data_point.valid_time,
-                synthesized=True
-            )
+    if not isinstance(model_data, DataPointBatch):
+        model_data = DataPointBatch.from_data_points(model_data)
+
+    if len(model_data) == 0:
+        return model_data
 
-        combined_sets[(metric.id, model_data_point.valid_time)].values.extend(model_data_point.values)
+    # Sort so all points for a (metric, valid_time) are next to each other, keeping
+    # their original relative order. After that, each run of points is one combined point,
+    # and its values are already contiguous.
+    grouped = model_data.take(numpy.lexsort((model_data.valid_time, model_data.metric_id)))
 
-    return list(combined_sets.values())
+    group_starts = numpy.flatnonzero(numpy.concatenate([
+        [True],
+        (grouped.metric_id[1:] != grouped.metric_id[:-1]) | (grouped.valid_time[1:] != grouped.valid_time[:-1]),
+    ]))
+
+    return DataPointBatch(
+        valid_time=grouped.valid_time[group_starts],
+        metric_id=grouped.metric_id[group_starts],
+        values=grouped.values,
+        offsets=numpy.append(grouped.offsets[group_starts], grouped.offsets[-1]),
+        synthesized=numpy.ones(len(group_starts), dtype=bool),
+    )
 
 
 def time_of_day(dt):
@@ -201,6 +210,11 @@ class PrecipEvent(TimeRangeEvent):
         }
 
 
+class SummaryPoint(NamedTuple):
+    valid_time: datetime.datetime
+    median: float
+
+
 class SummarizedData(object):
     """
     Represents a summarized view of metrics over the given time span
@@ -209,7 +223,7 @@ class SummarizedData(object):
     end: datetime.datetime
     resolution: datetime.timedelta
 
-    data_points: List[DataPointSet]
+    data_points: DataPointBatch
 
     # There are two different types of summarized datas:
     # Continuous metrics (one per resolution unit)
@@ -226,15 +240,25 @@ class SummarizedData(object):
             self,
             start: datetime.datetime,
             end: datetime.datetime,
-            data_points: Iterable[DataPointSet],
+            data_points: Union[DataPointBatch, Iterable[DataPointSet]],
             resolution: datetime.timedelta = datetime.timedelta(hours=1),
     ):
         self.start = start
         self.end = end
         self.resolution = resolution
 
+        if not isinstance(data_points, DataPointBatch):
+            data_points = DataPointBatch.from_data_points(data_points)
+
         # Bound data points to within the specified start,end
-        self.data_points = sorted(filter(lambda d: start <= d.valid_time < end, data_points), key=lambda p: p.valid_time)
+        in_range = numpy.flatnonzero(
+            (datetime2numpy(start) <= data_points.valid_time) & (data_points.valid_time < datetime2numpy(end))
+        )
+        self.data_points = data_points.take(in_range[numpy.argsort(data_points.valid_time[in_range], kind='stable')])
+
+        # Times need to be tz-aware if start is so they can be compared against the time ranges
+        self._valid_times = self.data_points.valid_times(datetime.timezone.utc if start.tzinfo is not None else None)
+        self._medians = self.data_points.median()
 
         # temps, winds, and cloud cover are guaranteed to have values for each time interval
         self.temps = ContinuousTimeList(start, end, resolution)
@@ -252,53 +276,55 @@ class SummarizedData(object):
 
         self.analyze()
 
-    def points_for_metric(self, m: Metric) -> List[DataPointSet]:
-        return list(filter(lambda d: d.metric_id == m.id, self.data_points))
+    def points_for_metric(self, m: Metric) -> List[SummaryPoint]:
+        return [
+            SummaryPoint(self._valid_times[i], float(self._medians[i]))
+            for i in numpy.flatnonzero(self.data_points.metric_id == m.id)
+        ]
 
     def analyze(self):
-        for data_point in self.data_points:
-            if data_point.metric_id == metrics.temp.id:
-                e = TemperatureEvent(data_point.valid_time, data_point.median())
-                self.temps[e.time] = e
+        for data_point in self.points_for_metric(metrics.temp):
+            e = TemperatureEvent(data_point.valid_time, data_point.median)
+            self.temps[e.time] = e
 
-                if self.low is None or e.temperature < self.low.temperature:
-                    self.low = e
-                if self.high is None or e.temperature > self.high.temperature:
-                    self.high = e
+            if self.low is None or e.temperature < self.low.temperature:
+                self.low = e
+            if self.high is None or e.temperature > self.high.temperature:
+                self.high = e
 
         for valid_time, (wind_speed, wind_direction, gust_speed) in group_by_time([
                 self.points_for_metric(metrics.wind_speed),
                 self.points_for_metric(metrics.wind_direction),
                 self.points_for_metric(metrics.gust_speed),
         ]):
-            e = WindEvent(valid_time, wind_speed.median(), wind_direction.median(), gust_speed.median())
+            e = WindEvent(valid_time, wind_speed.median, wind_direction.median, gust_speed.median)
             self.winds[e.time] = e
 
-        for cover, grp in itertools.groupby(self.points_for_metric(metrics.cloud_cover), key=lambda p: CloudCoverEvent.CLASSIFICATIONS[p.median()]):
+        for cover, grp in itertools.groupby(self.points_for_metric(metrics.cloud_cover), key=lambda p: CloudCoverEvent.CLASSIFICATIONS[p.median]):
             grp = list(grp)
             start = grp[0].valid_time
             end = grp[-1].valid_time
             e = CloudCoverEvent(start, end, cover)
             self.cloud_cover[e.start:e.end] = e
 
-        raining = list(filter(lambda d: d.median() == 1, self.points_for_metric(metrics.raining)))
+        raining = list(filter(lambda d: d.median == 1, self.points_for_metric(metrics.raining)))
         for intensity, grp in itertools.groupby(
                 [(time, rain, refl) for time, (rain, refl) in group_by_time([
                     raining,
                     self.points_for_metric(metrics.composite_reflectivity)])],
-                key=lambda t: PrecipEvent.CLASSIFICATIONS[t[2].median()]):
+                key=lambda t: PrecipEvent.CLASSIFICATIONS[t[2].median]):
             grp = list(grp)
             start = grp[0][0]
             end = grp[-1][0]
             e = PrecipEvent(start, end, 'rain', intensity)
             self.precip[e.start:e.end] = e
 
-        snowing = list(filter(lambda d: d.median() == 1, self.points_for_metric(metrics.snowing)))
+        snowing = list(filter(lambda d: d.median == 1, self.points_for_metric(metrics.snowing)))
         for intensity, grp in itertools.groupby(
                 [(time, snow, refl) for time, (snow, refl) in group_by_time([
                     snowing,
                     self.points_for_metric(metrics.composite_reflectivity)])],
-                key=lambda t: PrecipEvent.CLASSIFICATIONS[t[2].median()]):
+                key=lambda t: PrecipEvent.CLASSIFICATIONS[t[2].median]):
             grp = list(grp)
             start = grp[0][0]
             end = grp[-1][0]
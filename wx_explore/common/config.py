@@ -15,5 +15,63 @@ class Config():
     INGEST_MONGO_DATABASE   = "wx"
     INGEST_MONGO_COLLECTION = "wx"
 
+    S3_MAX_RETRIES = int(os.environ.get('S3_MAX_RETRIES', 3))
+    S3_RETRY_BACKOFF = float(os.environ.get('S3_RETRY_BACKOFF', 0.5))
+    S3_TIMEOUT = float(os.environ.get('S3_TIMEOUT', 30))
+    # Size of the in-process cache of chunks read from S3 (0 disables caching),
+    # and optionally where and how much to cache on local disk
+    S3_CACHE_BYTES = int(os.environ.get('S3_CACHE_BYTES', 128 * 1024 * 1024))
+    S3_CACHE_DIR = os.environ.get('S3_CACHE_DIR')
+    S3_CACHE_DISK_BYTES = int(os.environ.get('S3_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+    # Number of locations per compressed block in newly written S3 rows (0 writes uncompressed rows)
+    S3_BLOCK_SIZE = int(os.environ.get('S3_BLOCK_SIZE', 0))
+
+    # Max age (seconds) of the in-memory band metadata index when change notifications can't be received
+    BAND_INDEX_MAX_AGE = float(os.environ.get('BAND_INDEX_MAX_AGE', 600))
+    # Number of days ahead to create band metadata partitions for (should cover the longest forecast ingested)
+    BAND_PARTITION_DAYS_AHEAD = int(os.environ.get('BAND_PARTITION_DAYS_AHEAD', 21))
+
+    # Max number of unneeded bytes to download between two wanted GRIB messages to be able
+    # to fetch both in one request, and number of GRIB requests to make in parallel
+    GRIB_RANGE_MAX_GAP = int(os.environ.get('GRIB_RANGE_MAX_GAP', 512 * 1024))
+    GRIB_DOWNLOAD_WORKERS = int(os.environ.get('GRIB_DOWNLOAD_WORKERS', 8))
+    # Number of processes to unpack GRIB message values with when ingesting a single GRIB file or item
+    # (ingest_grib_file and the Azure function)
+    GRIB_DECODE_WORKERS = int(os.environ.get('GRIB_DECODE_WORKERS', os.cpu_count() or 1))
+    # Number of processes each ingest worker process unpacks GRIB message values with. 0 splits the cores
+    # evenly between ingest worker processes (so values are unpacked in-process if there are none to spare)
+    INGEST_DECODE_WORKERS = int(os.environ.get('INGEST_DECODE_WORKERS', 0))
+
+    # Number of ingest worker processes, max number of items of the same source/run for one process to ingest together,
+    # and min available memory (bytes) needed to start ingesting more items
+    INGEST_PROCESSES = int(os.environ.get('INGEST_PROCESSES', os.cpu_count() or 1))
+    INGEST_GROUP_SIZE = int(os.environ.get('INGEST_GROUP_SIZE', 6))
+    INGEST_MIN_AVAILABLE_MEMORY = int(os.environ.get('INGEST_MIN_AVAILABLE_MEMORY', 1024 * 1024 * 1024))
+    # Max bytes of fields each ingest process buffers before writing them out, and max time (seconds) to wait
+    # for more items of a source/run to be able to ingest (and write) them together
+    INGEST_BUFFER_MAX_BYTES = int(os.environ.get('INGEST_BUFFER_MAX_BYTES', 1024 * 1024 * 1024))
+    INGEST_BUFFER_MAX_DELAY = float(os.environ.get('INGEST_BUFFER_MAX_DELAY', 60))
+    # How often (seconds) an idle worker checks the queue
+    INGEST_POLL_INTERVAL = float(os.environ.get('INGEST_POLL_INTERVAL', 10))
+    # Max time (seconds) to wait for items in progress to finish when stopping before rescheduling them
+    # (should be less than the time the process has to stop, e.g. k8s's terminationGracePeriodSeconds)
+    INGEST_SHUTDOWN_GRACE = float(os.environ.get('INGEST_SHUTDOWN_GRACE', 20))
+
+    # Max memory (bytes) merge can use for row buffers and loaded source rows, and how often (seconds)
+    # merge progress is checkpointed so an interrupted merge can be resumed
+    MERGE_MEMORY_BYTES = int(os.environ.get('MERGE_MEMORY_BYTES', 1024 * 1024 * 1024))
+    MERGE_CHECKPOINT_INTERVAL = float(os.environ.get('MERGE_CHECKPOINT_INTERVAL', 30))
+    # Max bytes each merge run reads and writes, and min number of reads per query a merge has to save to be worth doing
+    MERGE_REWRITE_BUDGET = int(os.environ.get('MERGE_REWRITE_BUDGET', 32 * 1024 * 1024 * 1024))
+    MERGE_MIN_READS_SAVED = float(os.environ.get('MERGE_MIN_READS_SAVED', 7))
+    # How often (seconds) counts of which files queries read are saved, for the merge planner
+    ACCESS_STATS_FLUSH_INTERVAL = float(os.environ.get('ACCESS_STATS_FLUSH_INTERVAL', 60))
+
+    INGEST_LOCAL_PATH = os.environ.get('INGEST_LOCAL_PATH', '/var/lib/wx_explore/data')
+
+    # Where projection coordinate lookup data is cached on local disk. Its contents are trusted, so it
+    # isn't used unless it's owned by (and only writable by) the current user.
+    PROJECTION_CACHE_DIR = os.environ.get('PROJECTION_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'wx_explore', 'projections'))
+
 
 Config.SQLALCHEMY_DATABASE_URI = f"postgresql://{Config.POSTGRES_USER}:{Config.POSTGRES_PASS}@{Config.POSTGRES_HOST}:{Config.POSTGRES_PORT}/{Config.POSTGRES_DB}"
@@ -1,6 +1,18 @@
-from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint, text
+from typing import Callable, Dict, List, TypeVar
+
+import datetime
+import logging
+import re
+
+from wx_explore.common.models import FileBandMeta
+from wx_explore.common.utils import run_in_thread
 from wx_explore.web.core import db
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
 
 def get_or_create(obj):
     """
@@ -23,3 +35,123 @@ def get_or_create(obj):
         # Commit so the result is guaranteed to have an id if applicable
         db.session.commit()
         return obj
+
+
+###
+# FileBandMeta partitions
+###
+
+BAND_PARTITION_RE = re.compile(FileBandMeta.__tablename__ + r'_(\d{8})$')
+BAND_DEFAULT_PARTITION = f"{FileBandMeta.__tablename__}_default"
+
+
+async def run_db_async(func: Callable[..., T], *args) -> T:
+    """
+    Runs the given (blocking) DB work on a worker thread so it doesn't block the event loop.
+    Objects returned are detached from any session, so only their already loaded attributes can be used.
+    """
+    def run():
+        try:
+            return func(*args)
+        finally:
+            # Worker threads outlive the request, so their (thread scoped) session has to be cleaned up here
+            db.session.remove()
+
+    return await run_in_thread(run)
+
+
+def band_partition_name(day: datetime.date) -> str:
+    return f"{FileBandMeta.__tablename__}_{day:%Y%m%d}"
+
+
+def band_partition_bounds(day: datetime.date) -> str:
+    return f"FROM ('{day.isoformat()}') TO ('{(day + datetime.timedelta(days=1)).isoformat()}')"
+
+
+def create_band_partition_ddl(day: datetime.date) -> str:
+    """
+    :return: DDL creating the given day's partition, for when the default partition has no bands for that day
+    """
+    return (
+        f"CREATE TABLE {band_partition_name(day)} PARTITION OF {FileBandMeta.__tablename__} "
+        f"FOR VALUES {band_partition_bounds(day)}"
+    )
+
+
+def band_partitions() -> Dict[datetime.date, str]:
+    """
+    :return: Dict of day -> name of that day's partition, for every existing daily partition
+    """
+    rows = db.session.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = :parent
+    """), {'parent': FileBandMeta.__tablename__})
+
+    partitions = {}
+    for name, in rows:
+        m = BAND_PARTITION_RE.match(name)
+        if m:
+            partitions[datetime.datetime.strptime(m.group(1), '%Y%m%d').date()] = name
+
+    return partitions
+
+
+def ensure_band_partitions(start: datetime.datetime, end: datetime.datetime) -> List[str]:
+    """
+    Create daily partitions for every day from start to end (inclusive) which doesn't have one,
+    moving any of that day's bands out of the default partition. Doesn't commit.
+    :return: Names of the created partitions
+    """
+    existing = band_partitions()
+    created = []
+
+    day = start.date()
+    while day <= end.date():
+        if day not in existing:
+            name = band_partition_name(day)
+            # A partition can't be created for a day the default partition has rows for (i.e. bands
+            # inserted before the day had a partition), so the partition is built on its own with
+            # those rows moved into it, then attached.
+            savepoint = db.session.begin_nested()
+            try:
+                db.session.execute(text(
+                    f"CREATE TABLE {name} (LIKE {FileBandMeta.__tablename__} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                ))
+                moved = db.session.execute(text(
+                    f"WITH moved AS ("
+                    f"  DELETE FROM {BAND_DEFAULT_PARTITION} WHERE valid_time >= :start AND valid_time < :end RETURNING *"
+                    f") INSERT INTO {name} SELECT * FROM moved"
+                ), {'start': day, 'end': day + datetime.timedelta(days=1)}).rowcount
+                db.session.execute(text(
+                    f"ALTER TABLE {FileBandMeta.__tablename__} ATTACH PARTITION {name} FOR VALUES {band_partition_bounds(day)}"
+                ))
+                savepoint.commit()
+                created.append(name)
+                if moved:
+                    logger.info("Moved %d bands from the default partition to %s", moved, name)
+            except Exception as e:
+                # e.g. another ingester created it first
+                savepoint.rollback()
+                logger.warning("Unable to create partition %s: %s", name, e)
+
+        day += datetime.timedelta(days=1)
+
+    return created
+
+
+def drop_band_partitions(before: datetime.datetime) -> List[str]:
+    """
+    Drop every daily partition which only holds bands valid before the given time. Doesn't commit.
+    :return: Names of the dropped partitions
+    """
+    dropped = []
+
+    for day, name in sorted(band_partitions().items()):
+        if datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()) <= before:
+            db.session.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+
+    return dropped
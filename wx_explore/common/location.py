@@ -1,21 +1,151 @@
-import math
+from scipy.spatial import cKDTree
+from typing import Callable, IO, Optional, Sequence, Tuple
+
+import logging
 import numpy
+import os
+import tempfile
 
+from wx_explore.common.config import Config
 from wx_explore.common.models import Projection
 from wx_explore.web.core import app, db
 
+logger = logging.getLogger(__name__)
+
+
+class CoordinateLookup(object):
+    """
+    Spatial index used to map (lat, lon) coordinates to the x,y of the nearest point in a projection's grid.
+
+    Grid points are indexed as 3D points on the unit sphere so that distances are correct
+    everywhere (including across the antimeridian and 0/360 wrap of global grids), and
+    nearest-neighbor queries are done with a KD-tree.
+    """
+    # Array of shape (n_y, n_x, 3) of grid points on the unit sphere
+    points: numpy.ndarray
+    tree: cKDTree
+    # Max (chord) distance a coordinate can be from its nearest grid point to still be considered covered by the grid
+    max_dist: float
+
+    def __init__(self, points: numpy.ndarray, max_dist: Optional[float] = None):
+        self.points = points
+
+        if max_dist is None:
+            # Anything further away than the largest spacing between adjacent grid points is outside the grid
+            max_dist = max(
+                numpy.linalg.norm(points[:, 1:] - points[:, :-1], axis=-1).max(initial=0),
+                numpy.linalg.norm(points[1:, :] - points[:-1, :], axis=-1).max(initial=0),
+            )
+
+        # The tree references (instead of copies) points, since they're already contiguous float64,
+        # so memory mapped points stay shared with other processes
+        self.tree = cKDTree(points.reshape((-1, 3)), copy_data=False)
+        self.max_dist = float(max_dist)
+
+    @property
+    def n_x(self) -> int:
+        return self.points.shape[1]
+
+    def query(self, coords: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :param coords: Array of shape (n, 2) of (lat, lon) pairs
+        :return: Array of shape (n, 2) of (x, y) pairs, and a boolean array of shape (n,) of
+                 whether each coordinate is actually covered by the grid
+        """
+        dists, idxs = self.tree.query(latlon_to_xyz(coords[:, 0], coords[:, 1]))
+        ys, xs = numpy.divmod(idxs, self.n_x)
+        return numpy.stack([xs, ys], axis=-1), dists <= self.max_dist
+
 
 lut_meta = {}
 
 
-def load_coordinate_lookup_meta(proj):
-    lats = numpy.array(proj.lats)
-    lons = numpy.array(proj.lons)
+def latlon_to_xyz(lats, lons) -> numpy.ndarray:
+    """
+    Convert the given lat(s), lon(s) (in degrees) to points on the unit sphere
+    """
+    lats = numpy.radians(lats)
+    lons = numpy.radians(lons)
+    cos_lats = numpy.cos(lats)
+
+    return numpy.stack([
+        cos_lats * numpy.cos(lons),
+        cos_lats * numpy.sin(lons),
+        numpy.sin(lats),
+    ], axis=-1)
+
+
+def _cache_path(proj, kind: str) -> str:
+    return os.path.join(Config.PROJECTION_CACHE_DIR, f"{proj.id}-{proj.ll_hash}.{kind}")
+
+
+def _atomic_write(path: str, write: Callable[[IO[bytes]], None]):
+    """
+    Write a file such that concurrent readers (other workers/processes) never see a partial file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _use_cache_dir() -> bool:
+    """
+    Create the cache dir if needed, and check that nobody else could have put anything in it
+    (cached data is trusted, and bad data would break every lookup)
+    """
+    path = Config.PROJECTION_CACHE_DIR
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.stat(path)
+    except OSError as e:
+        logger.warning("Unable to create projection cache dir %s: %s", path, e)
+        return False
+
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        logger.warning("Not using projection cache dir %s since it's not owned by (or is writable by others than) this user", path)
+        return False
+
+    return True
 
-    return (lats, lons)
 
+def is_coordinate_lookup_cached(proj) -> bool:
+    return all(os.path.exists(_cache_path(proj, kind)) for kind in ('points.npy', 'max_dist.npy'))
 
-def get_lookup_meta(proj):
+
+def cache_coordinate_lookup_meta(proj) -> CoordinateLookup:
+    """
+    Build the coordinate lookup for the given projection from the DB, and persist it on disk
+    so other processes can load it without having to go through the DB.
+    """
+    logger.info("Building coordinate lookup cache for projection %d", proj.id)
+
+    lookup = CoordinateLookup(latlon_to_xyz(numpy.array(proj.lats), numpy.array(proj.lons)))
+
+    if _use_cache_dir():
+        _atomic_write(_cache_path(proj, 'points.npy'), lambda f: numpy.save(f, lookup.points))
+        _atomic_write(_cache_path(proj, 'max_dist.npy'), lambda f: numpy.save(f, numpy.float64(lookup.max_dist)))
+
+    return lookup
+
+
+def load_coordinate_lookup_meta(proj) -> CoordinateLookup:
+    if not _use_cache_dir() or not is_coordinate_lookup_cached(proj):
+        return cache_coordinate_lookup_meta(proj)
+
+    # Points (the bulk of the lookup) are memory mapped so that pages are shared between all processes
+    # on this machine. Only the KD-tree's index is built per process, which takes ~1s for the largest grids.
+    points = numpy.load(_cache_path(proj, 'points.npy'), mmap_mode='r', allow_pickle=False)
+    max_dist = numpy.load(_cache_path(proj, 'max_dist.npy'), allow_pickle=False)
+
+    return CoordinateLookup(points, max_dist)
+
+
+def get_lookup_meta(proj) -> CoordinateLookup:
     if proj.id not in lut_meta:
         lut_meta[proj.id] = load_coordinate_lookup_meta(proj)
     return lut_meta[proj.id]
@@ -23,51 +153,41 @@ def get_lookup_meta(proj):
 
 def preload_coordinate_lookup_meta():
     """
-    Preload all projection metadata for quick lookups
+    Make sure the on-disk lookup cache exists for all projections so that lookups
+    can be lazily loaded without touching the DB.
     """
+    if not _use_cache_dir():
+        return
+
     with app.app_context():
         for proj in Projection.query.all():
-            get_lookup_meta(proj)
+            if not is_coordinate_lookup_cached(proj):
+                cache_coordinate_lookup_meta(proj)
 
 
 def clear_proj_cache():
-    for k in lut_meta:
-        del lut_meta[k]
+    lut_meta.clear()
 
 
-def _dist(x, y, lat, lon, projlats, projlons):
-    return math.sqrt((lat - projlats[y][x])**2 + (lon - projlons[y][x])**2)
+def get_xy_for_coords(proj, coords_array) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Returns the x,y for each (lat, lon) coordinate in coords_array on the given projection
+    :param coords_array: Array-like of shape (n, 2) of (lat, lon) pairs
+    :return: Array of shape (n, 2) of (x, y) pairs, and a boolean array of shape (n,) which is
+             False for any coordinate that isn't covered by the projection
+    """
+    coords_array = numpy.asarray(coords_array, dtype=numpy.float64).reshape((-1, 2))
+    return get_lookup_meta(proj).query(coords_array)
 
 
-def get_xy_for_coord(proj, coords):
+def get_xy_for_coord(proj, coords: Sequence[float]) -> Optional[Tuple[int, int]]:
     """
     Returns the x,y for a given (lat, lon) coordinate on the given projection
     """
-    projlats, projlons = get_lookup_meta(proj)
-
-    lat, lon = coords
+    xys, covered = get_xy_for_coords(proj, [coords])
 
-    if not (projlons.min() <= lon <= projlons.max() and projlats.min() <= lat <= projlats.max()):
+    if not covered[0]:
         return None
 
-    x = proj.n_x // 2
-    y = proj.n_y // 2
-
-    # Dumb walk to figure out best x,y
-    # Easier on memory than keeping kdtrees and not that much slower since we don't hit this very often
-    while True:
-        best = (None, None, None)  # dist, dx, dy
-
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                dist = _dist((x + dx) % proj.n_x, (y + dy) % proj.n_y, lat, lon, projlats, projlons)
-                if best[0] is None or dist < best[0]:
-                    best = (dist, dx, dy)
-
-        if best[1] == 0 and best[2] == 0:
-            break
-
-        x = (x + best[1]) % proj.n_x
-        y = (y + best[2]) % proj.n_y
-
-    return (x, y)
+    x, y = xys[0]
+    return (int(x), int(y))
@@ -1,69 +1,89 @@
 from wx_explore.common.models import Metric
 from wx_explore.common.db_utils import get_or_create
-from wx_explore.web.core import app
+from wx_explore.web.core import app, db
+
+
+def get_or_create_metric(metric: Metric) -> Metric:
+    """
+    Like get_or_create, but also updates the encoding of an existing metric (which get_or_create
+    wouldn't, since it only looks metrics up by name) so encoding changes take effect.
+    """
+    encoding = metric.encoding
+    metric = get_or_create(metric)
+    if metric.encoding != encoding:
+        metric.encoding = encoding
+        db.session.commit()
+    return metric
+
 
 with app.app_context():
-    temp = get_or_create(Metric(
+    temp = get_or_create_metric(Metric(
         name='2m Temperature',
         units='K',
     ))
-    visibility = get_or_create(Metric(
+    visibility = get_or_create_metric(Metric(
         name='Visibility',
         units='m',
     ))
-    raining = get_or_create(Metric(
+    raining = get_or_create_metric(Metric(
         name='Rain',
         units='',
+        encoding='bool',
     ))
-    ice = get_or_create(Metric(
+    ice = get_or_create_metric(Metric(
         name='Ice',
         units='',
+        encoding='bool',
     ))
-    freezing_rain = get_or_create(Metric(
+    freezing_rain = get_or_create_metric(Metric(
         name='Freezing Rain',
         units='',
+        encoding='bool',
     ))
-    snowing = get_or_create(Metric(
+    snowing = get_or_create_metric(Metric(
         name='Snow',
         units='',
+        encoding='bool',
     ))
-    composite_reflectivity = get_or_create(Metric(
+    composite_reflectivity = get_or_create_metric(Metric(
         name='Composite Reflectivity',
         units='dbZ',
+        encoding='u1',
     ))
-    humidity = get_or_create(Metric(
+    humidity = get_or_create_metric(Metric(
         name='2m Humidity',
         units='kg/kg',
     ))
-    pressure = get_or_create(Metric(
+    pressure = get_or_create_metric(Metric(
         name='Surface Pressure',
         units='Pa',
     ))
-    wind_u = get_or_create(Metric(
+    wind_u = get_or_create_metric(Metric(
         name='10m Wind U-component',
         units='m/s',
         intermediate=True,
     ))
-    wind_v = get_or_create(Metric(
+    wind_v = get_or_create_metric(Metric(
         name='10m Wind V-component',
         units='deg',
         intermediate=True,
     ))
-    wind_speed = get_or_create(Metric(
+    wind_speed = get_or_create_metric(Metric(
         name='10m Wind Speed',
         units='m/s',
     ))
-    wind_direction = get_or_create(Metric(
+    wind_direction = get_or_create_metric(Metric(
         name='10m Wind Direction',
         units='deg',
     ))
-    gust_speed = get_or_create(Metric(
+    gust_speed = get_or_create_metric(Metric(
         name='Gust Speed',
         units='m/s',
     ))
-    cloud_cover = get_or_create(Metric(
+    cloud_cover = get_or_create_metric(Metric(
         name='Cloud Cover',
         units='%',
+        encoding='u1',
     ))
 
 ALL_METRICS = [
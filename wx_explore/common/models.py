@@ -2,13 +2,17 @@ from geoalchemy2 import Geography, Geometry
 from pytz import timezone
 from shapely import wkb
 from sqlalchemy import (
+    DDL,
     Column,
     Integer, BigInteger,
     String,
     Boolean,
     DateTime,
+    Float,
     ForeignKey,
+    Index,
     UniqueConstraint,
+    event,
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import deferred, relationship
@@ -63,6 +67,8 @@ class Metric(Base):
     units = Column(String(16))
     # intermediate metrics aren't displayed to the end user, and are only used for deriving other metrics
     intermediate = Column(Boolean, nullable=False, default=False)
+    # How values are stored (see storage.encoding). NULL means float32
+    encoding = Column(String(8), nullable=True)
 
     def serialize(self):
         return {
@@ -184,6 +190,8 @@ class FileMeta(Base):
     projection_id = Column(Integer, ForeignKey('projection.id'))
     ctime = Column(DateTime, default=datetime.datetime.utcnow)
     loc_size = Column(Integer, nullable=False)
+    # Number of locations per compressed block (see storage.stripe_format), or NULL if rows are stored raw
+    block_size = Column(Integer, nullable=True)
 
     projection = relationship('Projection')
 
@@ -191,26 +199,99 @@ class FileMeta(Base):
 class FileBandMeta(Base):
     """
     Table that holds data about specific runs of denormalized data in the given file.
+
+    Range partitioned by valid_time, one partition per day (see db_utils.ensure_band_partitions),
+    so that expiring a day of data is dropping its partition.
     """
     __tablename__ = "file_band_meta"
+    __table_args__ = (
+        # Covers finding bands by field and time without having to visit the table
+        Index(
+            'file_band_meta_field_time_idx',
+            'source_field_id', 'valid_time',
+            postgresql_include=['offset', 'vals_per_loc', 'run_time', 'file_name'],
+        ),
+        {'postgresql_partition_by': 'RANGE (valid_time)'},
+    )
 
     # TODO: on delete of file meta, delete these
     # PKs
     file_name = Column(String, ForeignKey('file_meta.file_name'), primary_key=True)
     offset = Column(Integer, primary_key=True)  # offset within a (x,y) chunk, _not_ offset in the entire file
+    valid_time = Column(DateTime, primary_key=True)  # postgres requires the partition key be part of the PK
 
-    # Metadata used to seek into the file
+    # Metadata used to seek into the file and decode values (see storage.encoding)
     vals_per_loc = Column(Integer)
+    encoding = Column(String(8), nullable=True)  # NULL means float32
+    scale = Column(Float, nullable=True)
+    add_offset = Column(Float, nullable=True)
 
     # Metadata
     source_field_id = Column(Integer, ForeignKey('source_field.id'))
-    valid_time = Column(DateTime)
     run_time = Column(DateTime)
 
     file_meta = relationship('FileMeta', backref='bands', lazy='joined')
     source_field = relationship('SourceField', lazy='joined')
 
 
+# Anything not covered by a daily partition goes here, so inserts never fail for lack of a partition
+event.listen(
+    FileBandMeta.__table__,
+    'after_create',
+    DDL("CREATE TABLE file_band_meta_default PARTITION OF file_band_meta DEFAULT"),
+)
+
+
+@event.listens_for(FileBandMeta.__table__, 'after_create')
+def create_initial_band_partitions(target, connection, **kw):
+    """
+    Create the partitions for upcoming days along with the table, instead of waiting for the first clean
+    """
+    # db_utils needs the models
+    from wx_explore.common.config import Config
+    from wx_explore.common.db_utils import create_band_partition_ddl
+
+    today = datetime.datetime.utcnow().date()
+    for days in range(Config.BAND_PARTITION_DAYS_AHEAD + 1):
+        connection.execute(DDL(create_band_partition_ddl(today + datetime.timedelta(days=days))))
+
+
+class FileAccessStats(Base):
+    """
+    Table that holds how often each file group is read by queries, so that merging can
+    prioritize the files which cost queries the most reads.
+    """
+    __tablename__ = "file_access_stats"
+
+    file_name = Column(String, primary_key=True)
+    projection_id = Column(Integer, ForeignKey('projection.id'), index=True)
+    # Number of queries which read from this file, and number of queries of its projection since
+    # the first one which did (i.e. queries / projection_queries is the fraction of queries which read it)
+    queries = Column(BigInteger, nullable=False, default=0)
+    projection_queries = Column(BigInteger, nullable=False, default=0)
+
+
+class MergeCheckpoint(Base):
+    """
+    Table that holds the progress of merging file groups into a new file group, so that
+    an interrupted merge can be resumed instead of started over.
+    """
+    __tablename__ = "merge_checkpoint"
+
+    file_name = Column(String, ForeignKey('file_meta.file_name'), primary_key=True)  # merged file
+    # Where every merged band's values come from and go: [[source file name, source offset, size, merged offset], ...]
+    plan = Column(JSONB, nullable=False)
+    # Rows of the merged file which have been fully written
+    rows_done = Column(JSONB, nullable=False, default=list)
+    attempts = Column(Integer, nullable=False, default=0)
+    mtime = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    merged_file = relationship('FileMeta')
+
+    def source_file_names(self) -> List[str]:
+        return sorted(set(src for src, _, _, _ in self.plan))
+
+
 class DataPointSet(object):
     """
     Non-db object which holds values and metadata for given data point (loc, time)
@@ -266,3 +347,204 @@ class DataPointSet(object):
         vals = numpy.array(self.values)
         n_within_stddev = (abs(vals - self.mean()) < numpy.std(vals)).sum()
         return n_within_stddev / len(vals)
+
+
+class DataPointBatch(object):
+    """
+    Non-db columnar equivalent of a list of DataPointSets.
+
+    Metadata is stored as one array per field, and the values of all points are stored
+    back to back in a single float32 buffer: the values of point i are
+    values[offsets[i]:offsets[i+1]].
+    """
+    valid_time: numpy.ndarray  # datetime64[us]
+    metric_id: numpy.ndarray  # int64
+    values: numpy.ndarray  # float32
+    offsets: numpy.ndarray  # int64, one longer than the number of points
+    source_field_id: numpy.ndarray  # int64, -1 if unknown
+    run_time: numpy.ndarray  # datetime64[us], NaT if unknown
+    derived: numpy.ndarray  # bool
+    synthesized: numpy.ndarray  # bool
+
+    def __init__(
+            self,
+            valid_time,
+            metric_id,
+            values,
+            offsets,
+            source_field_id=None,
+            run_time=None,
+            derived=None,
+            synthesized=None):
+        n = len(valid_time)
+
+        self.valid_time = numpy.asarray(valid_time, dtype='datetime64[us]')
+        self.metric_id = numpy.asarray(metric_id, dtype=numpy.int64)
+        self.values = numpy.asarray(values, dtype=numpy.float32)
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+
+        # Optional fields
+        if source_field_id is None:
+            source_field_id = numpy.full(n, -1)
+        if run_time is None:
+            run_time = numpy.full(n, numpy.datetime64('NaT'))
+        if derived is None:
+            derived = numpy.zeros(n, dtype=bool)
+        if synthesized is None:
+            synthesized = numpy.zeros(n, dtype=bool)
+
+        self.source_field_id = numpy.asarray(source_field_id, dtype=numpy.int64)
+        self.run_time = numpy.asarray(run_time, dtype='datetime64[us]')
+        self.derived = numpy.asarray(derived, dtype=bool)
+        self.synthesized = numpy.asarray(synthesized, dtype=bool)
+
+    @classmethod
+    def empty(cls) -> 'DataPointBatch':
+        return cls([], [], [], [0])
+
+    @classmethod
+    def from_data_points(cls, data_points: List[DataPointSet]) -> 'DataPointBatch':
+        data_points = list(data_points)
+
+        lengths = [len(dp.values) for dp in data_points]
+
+        return cls(
+            valid_time=[dp.valid_time for dp in data_points],
+            metric_id=[dp.metric_id for dp in data_points],
+            values=[v for dp in data_points for v in dp.values],
+            offsets=numpy.concatenate([[0], numpy.cumsum(lengths, dtype=numpy.int64)]),
+            source_field_id=[dp.source_field_id if dp.source_field_id is not None else -1 for dp in data_points],
+            run_time=[dp.run_time if dp.run_time is not None else numpy.datetime64('NaT') for dp in data_points],
+            derived=[dp.derived for dp in data_points],
+            synthesized=[dp.synthesized for dp in data_points],
+        )
+
+    @classmethod
+    def concat(cls, batches: List['DataPointBatch']) -> 'DataPointBatch':
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+
+        offsets = [numpy.zeros(1, dtype=numpy.int64)]
+        n_values = 0
+        for b in batches:
+            offsets.append(b.offsets[1:] + n_values)
+            n_values += len(b.values)
+
+        return cls(
+            valid_time=numpy.concatenate([b.valid_time for b in batches]),
+            metric_id=numpy.concatenate([b.metric_id for b in batches]),
+            values=numpy.concatenate([b.values for b in batches]),
+            offsets=numpy.concatenate(offsets),
+            source_field_id=numpy.concatenate([b.source_field_id for b in batches]),
+            run_time=numpy.concatenate([b.run_time for b in batches]),
+            derived=numpy.concatenate([b.derived for b in batches]),
+            synthesized=numpy.concatenate([b.synthesized for b in batches]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.valid_time)
+
+    def __repr__(self):
+        return f"<DataPointBatch n={len(self)}>"
+
+    def lengths(self) -> numpy.ndarray:
+        """
+        Number of values in each point
+        """
+        return numpy.diff(self.offsets)
+
+    def point_values(self, i: int) -> numpy.ndarray:
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def take(self, idxs) -> 'DataPointBatch':
+        """
+        New batch of just the points with the given indexes, in the given order
+        """
+        idxs = numpy.asarray(idxs, dtype=numpy.int64)
+
+        lengths = self.lengths()[idxs]
+        offsets = numpy.concatenate([[0], numpy.cumsum(lengths, dtype=numpy.int64)])
+        # Index into self.values for every value of every taken point
+        value_idxs = numpy.repeat(self.offsets[idxs] - offsets[:-1], lengths) + numpy.arange(offsets[-1])
+
+        return DataPointBatch(
+            valid_time=self.valid_time[idxs],
+            metric_id=self.metric_id[idxs],
+            values=self.values[value_idxs],
+            offsets=offsets,
+            source_field_id=self.source_field_id[idxs],
+            run_time=self.run_time[idxs],
+            derived=self.derived[idxs],
+            synthesized=self.synthesized[idxs],
+        )
+
+    def valid_times(self, tz: Optional[datetime.tzinfo] = None) -> List[datetime.datetime]:
+        return [dt.replace(tzinfo=tz) for dt in self.valid_time.astype(datetime.datetime)]
+
+    def __getitem__(self, i: int) -> DataPointSet:
+        run_time = self.run_time[i]
+        source_field_id = int(self.source_field_id[i])
+
+        return DataPointSet(
+            values=self.point_values(i).tolist(),
+            metric_id=int(self.metric_id[i]),
+            valid_time=self.valid_time[i].astype(datetime.datetime),
+            source_field_id=source_field_id if source_field_id != -1 else None,
+            run_time=run_time.astype(datetime.datetime) if not numpy.isnat(run_time) else None,
+            derived=bool(self.derived[i]),
+            synthesized=bool(self.synthesized[i]),
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_data_points(self) -> List[DataPointSet]:
+        return list(self)
+
+    def _reduce(self, func) -> numpy.ndarray:
+        """
+        Apply func to the values of every point. Points are grouped by number of values so that
+        func is called with a 2D (points, values) array, and must reduce it along axis 1.
+        Points without any values are NaN.
+        """
+        lengths = self.lengths()
+        out = numpy.full(len(self), numpy.nan)
+
+        for length in numpy.unique(lengths):
+            if length == 0:
+                continue
+
+            idxs = numpy.flatnonzero(lengths == length)
+            vals = self.values[self.offsets[idxs, None] + numpy.arange(length)].astype(numpy.float64)
+            out[idxs] = func(vals)
+
+        return out
+
+    def min(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: vals.min(axis=1))
+
+    def max(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: vals.max(axis=1))
+
+    def median(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: numpy.median(vals, axis=1))
+
+    def median_confidence(self) -> numpy.ndarray:
+        def confidence(vals):
+            n_within_stddev = (abs(vals - numpy.median(vals, axis=1, keepdims=True)) < vals.std(axis=1, keepdims=True)).sum(axis=1)
+            return n_within_stddev / vals.shape[1]
+
+        return self._reduce(confidence)
+
+    def mean(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: vals.mean(axis=1))
+
+    def mean_confidence(self) -> numpy.ndarray:
+        def confidence(vals):
+            n_within_stddev = (abs(vals - vals.mean(axis=1, keepdims=True)) < vals.std(axis=1, keepdims=True)).sum(axis=1)
+            return n_within_stddev / vals.shape[1]
+
+        return self._reduce(confidence)
@@ -1,16 +1,22 @@
 from typing import Tuple, Optional, Iterable, Dict, List
 
+import asyncio
+import collections
 import concurrent.futures
 import datetime
+import functools
 import numpy
 
 from wx_explore.common import tracing
 from wx_explore.common.config import Config
-from wx_explore.common.location import get_xy_for_coord
+from wx_explore.common.db_utils import run_db_async
+from wx_explore.common.location import get_xy_for_coord, get_xy_for_coords
+from wx_explore.common.utils import run_in_thread
 from wx_explore.common.models import (
     SourceField,
     Projection,
     DataPointSet,
+    DataPointBatch,
 )
 
 
@@ -25,6 +31,39 @@ class DataProvider(object):
     ) -> List[DataPointSet]:
         raise NotImplementedError()
 
+    def get_fields_many(
+            self,
+            proj_id: int,
+            locs: List[Tuple[int, int]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> List[DataPointBatch]:
+        """
+        Like get_fields, but for many x,y locations on the same projection at once.
+        Returns one batch of data points per given loc, in the same order as locs.
+
+        Backends that can share work between locations (metadata lookups, reads of the
+        same underlying chunk, etc.) should override this.
+        """
+        return [
+            DataPointBatch.from_data_points(self.get_fields(proj_id, loc, valid_source_fields, start, end))
+            for loc in locs
+        ]
+
+    async def get_fields_many_async(
+            self,
+            proj_id: int,
+            locs: List[Tuple[int, int]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> List[DataPointBatch]:
+        """
+        Async version of get_fields_many. Defaults to running get_fields_many on a thread.
+        """
+        return await run_in_thread(self.get_fields_many, proj_id, locs, valid_source_fields, start, end)
+
     def put_fields(
             self,
             proj: Projection,
@@ -32,17 +71,36 @@ class DataProvider(object):
     ):
         raise NotImplementedError()
 
-    def clean(self, oldest_time: datetime.datetime):
+    def clean(self, oldest_time: datetime.datetime, scan_orphans: bool = False):
+        """
+        Remove data which is no longer needed
+        :param scan_orphans: Also look through all of storage for data that isn't tracked at all (which can be slow)
+        """
         raise NotImplementedError()
 
     def merge(self):
         raise NotImplementedError()
 
+    def plan_merges(self):
+        """
+        :return: What merge would do, without doing it
+        """
+        raise NotImplementedError()
+
 
+@functools.lru_cache(maxsize=None)
 def get_provider():
+    """
+    Get the configured data provider. The provider is shared by the whole process
+    so that its connection pools, caches, etc. are reused across calls.
+    """
     from .s3 import S3Backend
     from .azure_tables import AzureTableBackend
     from .mongo import MongoBackend
+    from .local import LocalMmapBackend
+    from .cache import ChunkCache
+    from .band_index import BandIndex
+    from .access_stats import AccessStats
 
     if Config.DATA_PROVIDER == "S3":
         return S3Backend(
@@ -51,6 +109,15 @@ def get_provider():
             Config.INGEST_S3_REGION,
             Config.INGEST_S3_BUCKET,
             Config.INGEST_S3_ENDPOINT,
+            max_retries=Config.S3_MAX_RETRIES,
+            retry_backoff=Config.S3_RETRY_BACKOFF,
+            timeout=Config.S3_TIMEOUT,
+            chunk_cache=(
+                ChunkCache(Config.S3_CACHE_BYTES, Config.S3_CACHE_DIR, Config.S3_CACHE_DISK_BYTES)
+                if Config.S3_CACHE_BYTES > 0 else None),
+            band_index=BandIndex(Config.BAND_INDEX_MAX_AGE),
+            block_size=Config.S3_BLOCK_SIZE,
+            access_stats=AccessStats(Config.ACCESS_STATS_FLUSH_INTERVAL),
         )
     elif Config.DATA_PROVIDER == "AZURE_TABLES":
         return AzureTableBackend(
@@ -64,6 +131,11 @@ def get_provider():
             Config.INGEST_MONGO_DATABASE,
             Config.INGEST_MONGO_COLLECTION,
         )
+    elif Config.DATA_PROVIDER == "LOCAL":
+        return LocalMmapBackend(
+            Config.INGEST_LOCAL_PATH,
+            band_index=BandIndex(Config.BAND_INDEX_MAX_AGE),
+        )
 
 
 def load_data_points(
@@ -107,3 +179,115 @@ def load_data_points(
         )
 
     return data_points
+
+
+def load_data_points_many(
+        coords_list: List[Tuple[float, float]],
+        start: datetime.datetime,
+        end: datetime.datetime,
+        source_fields: Optional[Iterable[SourceField]] = None
+) -> List[DataPointBatch]:
+    """
+    Batch version of load_data_points. Returns one batch of data points per (lat, lon) in coords_list.
+
+    All x,y lookups are done up front, and then each projection is queried once for all
+    locations it covers so the provider can share metadata lookups and reads between them.
+    """
+
+    proj_source_fields, proj_locs = _resolve_locs(coords_list, source_fields)
+
+    # Batches from each projection, per coord
+    results: List[List[DataPointBatch]] = [[] for _ in coords_list]
+
+    if not proj_locs:
+        return [DataPointBatch.empty() for _ in coords_list]
+
+    provider = get_provider()
+
+    def load_proj(proj_id):
+        locs = proj_locs[proj_id]
+        return locs, provider.get_fields_many(proj_id, [loc for _, loc in locs], proj_source_fields[proj_id], start, end)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(proj_locs)) as ex:
+        for locs, loc_data_points in ex.map(load_proj, proj_locs.keys()):
+            for (i, _), batch in zip(locs, loc_data_points):
+                results[i].append(batch)
+
+    return [DataPointBatch.concat(batches) for batches in results]
+
+
+async def load_data_points_many_async(
+        coords_list: List[Tuple[float, float]],
+        start: datetime.datetime,
+        end: datetime.datetime,
+        source_fields: Optional[Iterable[SourceField]] = None
+) -> List[DataPointBatch]:
+    """
+    Async version of load_data_points_many. All projections are loaded concurrently,
+    sharing the provider's async resources (connection pool, etc.).
+    """
+    proj_source_fields, proj_locs = await run_db_async(_resolve_locs, coords_list, source_fields)
+
+    # Batches from each projection, per coord
+    results: List[List[DataPointBatch]] = [[] for _ in coords_list]
+
+    if not proj_locs:
+        return [DataPointBatch.empty() for _ in coords_list]
+
+    provider = get_provider()
+
+    all_loc_data_points = await asyncio.gather(*(
+        provider.get_fields_many_async(proj_id, [loc for _, loc in locs], proj_source_fields[proj_id], start, end)
+        for proj_id, locs in proj_locs.items()
+    ))
+
+    for locs, loc_data_points in zip(proj_locs.values(), all_loc_data_points):
+        for (i, _), batch in zip(locs, loc_data_points):
+            results[i].append(batch)
+
+    return [DataPointBatch.concat(batches) for batches in results]
+
+
+async def load_data_points_async(
+        coords: Tuple[float, float],
+        start: datetime.datetime,
+        end: datetime.datetime,
+        source_fields: Optional[Iterable[SourceField]] = None
+) -> DataPointBatch:
+    """
+    Async version of load_data_points, returning a batch instead of a list.
+    """
+    return (await load_data_points_many_async([coords], start, end, source_fields))[0]
+
+
+def _resolve_locs(
+        coords_list: List[Tuple[float, float]],
+        source_fields: Optional[Iterable[SourceField]] = None
+) -> Tuple[Dict[int, List[SourceField]], Dict[int, List[Tuple[int, Tuple[int, int]]]]]:
+    """
+    Figure out which source fields to load and where for each of the given coords.
+    :return: Dict of projection id -> source fields on that projection, and
+             dict of projection id -> [(index into coords_list, (x, y)), ...] for all coords covered by that projection
+    """
+    if source_fields is None:
+        source_fields = SourceField.query.all()
+
+    proj_source_fields: Dict[int, List[SourceField]] = collections.defaultdict(list)
+    for sf in source_fields:
+        if sf.projection_id is None:
+            continue
+        proj_source_fields[sf.projection_id].append(sf)
+
+    proj_locs: Dict[int, List[Tuple[int, Tuple[int, int]]]] = {}
+    for proj_id, sfs in proj_source_fields.items():
+        with tracing.start_span("get_xy_for_coords") as span:
+            span.set_attribute("projection_id", proj_id)
+            span.set_attribute("num_coords", len(coords_list))
+            # Looked up by id since the given source fields may be detached (see run_db_async)
+            xys, covered = get_xy_for_coords(Projection.query.get(proj_id), coords_list)
+            locs = [(i, (int(x), int(y))) for i, (x, y) in enumerate(xys) if covered[i]]
+
+        if locs:
+            proj_locs[proj_id] = locs
+
+    return proj_source_fields, proj_locs
@@ -0,0 +1,114 @@
+from sqlalchemy.dialects.postgresql import insert
+from typing import Dict, Iterable
+
+import collections
+import logging
+import os
+import threading
+import time
+
+from wx_explore.common.models import (
+    FileAccessStats,
+)
+from wx_explore.web.core import app, db
+
+
+logger = logging.getLogger(__name__)
+
+
+class AccessStats(object):
+    """
+    Counts which files each query reads, and periodically adds the counts to FileAccessStats
+    (from a background thread, so queries never wait on the DB).
+    """
+    flush_interval: float
+
+    def __init__(self, flush_interval: float = 60):
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        # projection id -> number of queries
+        self._queries = collections.Counter()
+        # projection id -> file name -> number of queries which read it
+        self._hits = collections.defaultdict(collections.Counter)
+
+        self._flusher_pid = None
+
+    def _ensure_flushing(self):
+        # Only the flusher thread of the process that started it is running after a fork
+        if self._flusher_pid != os.getpid():
+            with self._lock:
+                if self._flusher_pid != os.getpid():
+                    self._queries.clear()
+                    self._hits.clear()
+                    threading.Thread(target=self._flush_loop, daemon=True, name='access-stats-flusher').start()
+                    self._flusher_pid = os.getpid()
+
+    def record(self, proj_id: int, file_names: Iterable[str]):
+        """
+        Record that a query of the given projection read the given files
+        """
+        self._ensure_flushing()
+
+        with self._lock:
+            self._queries[proj_id] += 1
+            self._hits[proj_id].update(set(file_names))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+
+            # This thread isn't part of any request, so it needs its own app context, and shouldn't
+            # hold on to a session (and connection) between flushes
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Unable to save access stats")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    def flush(self):
+        with self._lock:
+            queries, self._queries = self._queries, collections.Counter()
+            hits, self._hits = self._hits, collections.defaultdict(collections.Counter)
+
+        for proj_id, n_queries in queries.items():
+            # Every file already being tracked saw these queries, whether or not they read it...
+            FileAccessStats.query.filter(
+                FileAccessStats.projection_id == proj_id,
+            ).update({
+                FileAccessStats.projection_queries: FileAccessStats.projection_queries + n_queries,
+            }, synchronize_session=False)
+
+            if not hits[proj_id]:
+                continue
+
+            # ...and files which haven't been read before start being tracked now
+            stmt = insert(FileAccessStats).values([
+                {
+                    'file_name': file_name,
+                    'projection_id': proj_id,
+                    'queries': n_hits,
+                    'projection_queries': n_queries,
+                }
+                for file_name, n_hits in hits[proj_id].items()
+            ])
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[FileAccessStats.file_name],
+                set_={'queries': FileAccessStats.queries + stmt.excluded.queries},
+            ))
+
+        db.session.commit()
+
+
+def load_access_fractions(proj_id: int) -> Dict[str, float]:
+    """
+    :return: Dict of file name -> fraction of queries of the given projection which read it, for all files which have been read
+    """
+    return {
+        stats.file_name: stats.queries / stats.projection_queries
+        for stats in FileAccessStats.query.filter(FileAccessStats.projection_id == proj_id).all()
+        if stats.projection_queries > 0
+    }
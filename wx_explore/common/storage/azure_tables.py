@@ -175,7 +175,7 @@ class AzureTableBackend(DataProvider):
                         **row,
                     })
 
-    def clean(self, oldest_time: datetime.datetime):
+    def clean(self, oldest_time: datetime.datetime, scan_orphans: bool = False):
         earliest = oldest_time.replace(microsecond=0)
 
         for proj in Projection.query.all():
@@ -0,0 +1,263 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+import collections
+import datetime
+import logging
+import numpy
+import os
+import psycopg2
+import psycopg2.extensions
+import select
+import sqlalchemy
+import threading
+import time
+
+from .encoding import get_encoding
+from wx_explore.common.config import Config
+from wx_explore.common.models import (
+    FileMeta,
+    FileBandMeta,
+    Projection,
+)
+from wx_explore.common.utils import datetime2numpy
+from wx_explore.web.core import db
+
+
+logger = logging.getLogger(__name__)
+
+# Postgres NOTIFY channel used to tell readers that band metadata has changed.
+# Payloads are one of:
+#   * "*": anything may have changed
+#   * "{projection_id}": anything in the given projection may have changed
+#   * "{projection_id}:{file_name}": the given file group was added to the given projection
+NOTIFY_CHANNEL = 'file_band_meta'
+
+
+class BandFile(NamedTuple):
+    file_name: str
+    loc_size: int
+    block_size: Optional[int]
+    n_x: int
+
+
+class Band(NamedTuple):
+    """
+    Lightweight, read only copy of a FileBandMeta
+    """
+    file: BandFile
+    offset: int
+    vals_per_loc: int
+    encoding: str
+    scale: Optional[float]
+    add_offset: Optional[float]
+    source_field_id: int
+    valid_time: datetime.datetime
+    run_time: datetime.datetime
+
+
+def notify_bands_changed(projection_id: Optional[int] = None, file_name: Optional[str] = None):
+    """
+    Tell all band indexes that bands have changed. This is sent as part of the current
+    transaction, so it is only delivered if/when the transaction is committed.
+    :param projection_id: Projection the changed bands are in, or None if bands in any projection may have changed
+    :param file_name: If all changed bands are in a newly added file group, the file group's name
+    """
+    if projection_id is None:
+        payload = '*'
+    elif file_name is None:
+        payload = str(projection_id)
+    else:
+        payload = f"{projection_id}:{file_name}"
+
+    db.session.execute(sqlalchemy.text("SELECT pg_notify(:channel, :payload)"), {'channel': NOTIFY_CHANNEL, 'payload': payload})
+
+
+class ProjectionBands(object):
+    """
+    All bands in a projection, sorted by valid_time.
+    """
+    bands: List[Band]
+    file_names: Set[str]
+    valid_times: numpy.ndarray
+    source_field_ids: numpy.ndarray
+    loaded_at: float
+
+    def __init__(self, bands: Iterable[Band]):
+        self.bands = sorted(bands, key=lambda b: b.valid_time)
+        self.file_names = set(b.file.file_name for b in self.bands)
+        self.valid_times = numpy.array([b.valid_time for b in self.bands], dtype='datetime64[us]')
+        self.source_field_ids = numpy.array([b.source_field_id for b in self.bands], dtype=numpy.int64)
+        self.loaded_at = time.monotonic()
+
+    def with_added(self, bands: Iterable[Band]) -> 'ProjectionBands':
+        # Files may have already been seen by the load they were added during
+        added = ProjectionBands(self.bands + [b for b in bands if b.file.file_name not in self.file_names])
+        # Age is based on the last full load
+        added.loaded_at = self.loaded_at
+        return added
+
+    def query(self, source_field_ids: Iterable[int], start: datetime.datetime, end: datetime.datetime) -> List[Band]:
+        lo = numpy.searchsorted(self.valid_times, datetime2numpy(start), side='left')
+        hi = numpy.searchsorted(self.valid_times, datetime2numpy(end), side='left')
+
+        matches = numpy.isin(self.source_field_ids[lo:hi], numpy.fromiter(source_field_ids, dtype=numpy.int64))
+        return [self.bands[lo + i] for i in numpy.flatnonzero(matches)]
+
+
+class BandIndex(object):
+    """
+    In-memory index of all band metadata per projection, so that reads don't need to query Postgres.
+
+    Projections are loaded on first use and kept up to date by listening for notifications
+    from whatever changes band metadata (see notify_bands_changed). New file groups are
+    added incrementally; any other change reloads the projection. If notifications can't be
+    received, projections are reloaded once they are older than max_age seconds.
+    """
+    max_age: float
+
+    def __init__(self, max_age: float = 600):
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._projections: Dict[int, ProjectionBands] = {}
+        # Projections being loaded for the first time, whose notifications need to be kept until the load is done
+        self._loading: Set[int] = set()
+        # Projections which need a full reload
+        self._stale: Set[int] = set()
+        # Projection id -> new file groups which need to be added
+        self._pending_files: Dict[int, Set[str]] = collections.defaultdict(set)
+
+        self._listener_pid = None
+        self._listening = False
+
+    def _handle_notification(self, payload: str):
+        with self._lock:
+            if payload == '*':
+                self._stale.update(self._projections.keys())
+                self._stale.update(self._loading)
+                return
+
+            proj_id, _, file_name = payload.partition(':')
+            proj_id = int(proj_id)
+
+            # Projections which aren't loaded will be up to date whenever they are
+            if proj_id not in self._projections and proj_id not in self._loading:
+                return
+
+            if file_name:
+                self._pending_files[proj_id].add(file_name)
+            else:
+                self._stale.add(proj_id)
+
+    def _listen(self):
+        while True:
+            try:
+                conn = psycopg2.connect(
+                    user=Config.POSTGRES_USER,
+                    password=Config.POSTGRES_PASS,
+                    host=Config.POSTGRES_HOST,
+                    port=Config.POSTGRES_PORT,
+                    dbname=Config.POSTGRES_DB,
+                )
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+                # Anything could have changed while we weren't listening
+                self._handle_notification('*')
+                self._listening = True
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        self._handle_notification(conn.notifies.pop(0).payload)
+            except Exception:
+                logger.exception("Error listening for band changes. Retrying...")
+                self._listening = False
+                time.sleep(10)
+
+    def _ensure_listening(self):
+        # Only the listener thread of the process that started it is running after a fork
+        if self._listener_pid != os.getpid():
+            with self._lock:
+                if self._listener_pid != os.getpid():
+                    self._listening = False
+                    self._projections.clear()
+                    self._loading.clear()
+                    threading.Thread(target=self._listen, daemon=True, name='band-index-listener').start()
+                    self._listener_pid = os.getpid()
+
+    @staticmethod
+    def _load_bands(*filters) -> List[Band]:
+        rows = db.session.query(
+            FileBandMeta.file_name,
+            FileMeta.loc_size,
+            FileMeta.block_size,
+            Projection.n_x,
+            FileBandMeta.offset,
+            FileBandMeta.vals_per_loc,
+            FileBandMeta.encoding,
+            FileBandMeta.scale,
+            FileBandMeta.add_offset,
+            FileBandMeta.source_field_id,
+            FileBandMeta.valid_time,
+            FileBandMeta.run_time,
+        ).join(
+            FileMeta, FileMeta.file_name == FileBandMeta.file_name,
+        ).join(
+            Projection, Projection.id == FileMeta.projection_id,
+        ).filter(*filters).all()
+
+        return [
+            Band(
+                BandFile(file_name, loc_size, block_size, n_x),
+                offset, vals_per_loc, get_encoding(encoding), scale, add_offset,
+                source_field_id, valid_time, run_time,
+            )
+            for (
+                file_name, loc_size, block_size, n_x,
+                offset, vals_per_loc, encoding, scale, add_offset,
+                source_field_id, valid_time, run_time,
+            ) in rows
+        ]
+
+    def get(self, proj_id: int) -> ProjectionBands:
+        self._ensure_listening()
+
+        with self._lock:
+            bands = self._projections.get(proj_id)
+            stale = (
+                bands is None
+                or proj_id in self._stale
+                or (not self._listening and time.monotonic() - bands.loaded_at > self.max_age)
+                or time.monotonic() - bands.loaded_at > self.max_age * 6
+            )
+            pending_files = self._pending_files.pop(proj_id, set())
+            self._stale.discard(proj_id)
+            first_load = bands is None
+            if first_load:
+                self._loading.add(proj_id)
+
+        try:
+            if stale:
+                bands = ProjectionBands(self._load_bands(FileMeta.projection_id == proj_id))
+            elif pending_files:
+                bands = bands.with_added(self._load_bands(FileBandMeta.file_name.in_(pending_files)))
+            else:
+                return bands
+
+            with self._lock:
+                self._projections[proj_id] = bands
+        finally:
+            if first_load:
+                with self._lock:
+                    self._loading.discard(proj_id)
+
+        # Anything notified during the load is applied by the next get
+        return bands
+
+    def query(self, proj_id: int, source_field_ids: Iterable[int], start: datetime.datetime, end: datetime.datetime) -> List[Band]:
+        return self.get(proj_id).query(source_field_ids, start, end)
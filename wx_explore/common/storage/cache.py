@@ -0,0 +1,192 @@
+from typing import Dict, Hashable, Optional
+
+import collections
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+class ChunkCache(object):
+    """
+    Bounded LRU cache of chunks read from storage, with byte-size accounting.
+
+    Keys should identify immutable data (e.g. (file_name, y, x), since file groups are never
+    modified once written), so nothing ever needs to be invalidated: stale entries just
+    stop being used and eventually get evicted.
+
+    There are two tiers:
+        * An in-process memory tier of up to max_bytes
+        * An optional local disk tier of up to max_disk_bytes in disk_dir. Since entries are
+          looked up directly on disk, this tier is shared by all processes using the same directory.
+          Whenever a process thinks the directory is over max_disk_bytes (going by its size when it
+          was last scanned, plus what the process wrote since), it scans the directory and removes the
+          least recently used entries of any process, including ones left over from before a restart.
+    """
+    # After a scan, the disk tier is trimmed down to this fraction of max_disk_bytes, so that
+    # directory scans aren't needed on every write
+    DISK_LOW_WATERMARK = 0.9
+    # Temp files older than this are from writers which died mid-write
+    STALE_TMP_SECS = 60 * 60
+
+    logger: logging.Logger
+    max_bytes: int
+    disk_dir: Optional[str]
+    max_disk_bytes: int
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, max_disk_bytes: int = 0):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # Size of the disk tier as of the last scan, plus what this process wrote since
+        self._disk_bytes = 0
+        self._scan_lock = threading.Lock()
+
+        self._counters = collections.Counter()
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _disk_path(self, key: Hashable) -> str:
+        return os.path.join(self.disk_dir, '-'.join(str(k) for k in key))
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return data
+
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                    # mtime is used as the last use time of disk entries
+                    os.utime(f.fileno())
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self._counters['disk_hits'] += 1
+                self._put_memory(key, data)
+                return data
+
+        with self._lock:
+            self._counters['misses'] += 1
+
+        return None
+
+    def put(self, key: Hashable, data: bytes):
+        self._put_memory(key, data)
+
+        if self.disk_dir is not None and len(data) <= self.max_disk_bytes:
+            self._put_disk(key, data)
+
+    def _put_memory(self, key: Hashable, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+
+            self._entries[key] = data
+            self._bytes += len(data)
+
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._counters['evictions'] += 1
+
+    def _put_disk(self, key: Hashable, data: bytes):
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+
+        try:
+            # Write then rename so other processes never read a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, prefix='.')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.logger.warning("Unable to write cache entry to disk: %s", e)
+            return
+
+        with self._lock:
+            self._disk_bytes += len(data)
+            over = self._disk_bytes > self.max_disk_bytes
+
+        if over:
+            self._scan_disk()
+
+    def _scan_disk(self):
+        """
+        Find the actual size of the disk tier (which other processes also write to), and remove
+        the least recently used entries if it's over max_disk_bytes
+        """
+        # Another thread scanning will handle it
+        if not self._scan_lock.acquire(blocking=False):
+            return
+
+        try:
+            now = time.time()
+            entries = []
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+
+                    if entry.name.startswith('.') and now - st.st_mtime < self.STALE_TMP_SECS:
+                        continue
+
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            if total > self.max_disk_bytes:
+                target = self.max_disk_bytes * self.DISK_LOW_WATERMARK
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    evicted += 1
+
+            with self._lock:
+                self._disk_bytes = total
+                self._counters['disk_evictions'] += evicted
+        except OSError as e:
+            self.logger.warning("Unable to scan disk cache: %s", e)
+        finally:
+            self._scan_lock.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'cache_hits': self._counters['hits'],
+                'cache_disk_hits': self._counters['disk_hits'],
+                'cache_misses': self._counters['misses'],
+                'cache_evictions': self._counters['evictions'],
+                'cache_disk_evictions': self._counters['disk_evictions'],
+                'cache_entries': len(self._entries),
+                'cache_bytes': self._bytes,
+                'cache_disk_bytes': self._disk_bytes,
+            }
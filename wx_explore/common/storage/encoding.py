@@ -0,0 +1,160 @@
+"""
+Encodings bands can be stored with in a location chunk (see FileBandMeta.encoding and Metric.encoding).
+
+    * f4: float32 (the default)
+    * u1: unsigned 8 bit integers, scaled to the range of the band's values
+    * i2: signed 16 bit integers, scaled to the range of the band's values
+    * bool: bitpacked flags (values > 0.5 are true). Bits are only packed within a single band,
+            so a band with one value per location still takes a byte.
+
+Scaled integer values decode as `code * scale + add_offset`, with one code reserved for NaN.
+Everything is little endian.
+"""
+from typing import List, Optional, Tuple
+
+import numpy
+
+F4 = 'f4'
+U1 = 'u1'
+I2 = 'i2'
+BOOL = 'bool'
+
+ENCODINGS = (F4, U1, I2, BOOL)
+
+# encoding -> (code dtype, NaN code, min code, max code)
+_SCALED = {
+    U1: (numpy.dtype('u1'), 255, 0, 254),
+    I2: (numpy.dtype('<i2'), -32768, -32767, 32767),
+}
+
+
+def get_encoding(encoding: Optional[str]) -> str:
+    if encoding is None:
+        return F4
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}")
+    return encoding
+
+
+def value_size(encoding: str, vals_per_loc: int) -> int:
+    """
+    :return: Number of bytes a band with the given encoding takes in each location chunk
+    """
+    if encoding == BOOL:
+        return -(-vals_per_loc // 8)
+    if encoding in _SCALED:
+        return _SCALED[encoding][0].itemsize * vals_per_loc
+    return 4 * vals_per_loc
+
+
+def encode(encoding: str, msgs: List[numpy.ndarray]) -> Tuple[numpy.ndarray, Optional[float], Optional[float]]:
+    """
+    Encode all values of a band
+    :param msgs: Values of each message in the band, all with the same shape
+    :return: uint8 array of encoded values with an extra last axis of value_size(encoding, len(msgs)) bytes,
+             and the scale and add_offset to decode with (None if not a scaled encoding)
+    """
+    if encoding == BOOL:
+        flags = numpy.stack([msg > 0.5 for msg in msgs], axis=-1)
+        return numpy.packbits(flags, axis=-1), None, None
+
+    if encoding in _SCALED:
+        dtype, nan_code, min_code, max_code = _SCALED[encoding]
+        vals = numpy.stack(msgs, axis=-1).astype(numpy.float64)
+
+        finite = numpy.isfinite(vals)
+        if finite.any():
+            lo, hi = vals[finite].min(), vals[finite].max()
+        else:
+            lo, hi = 0.0, 0.0
+
+        scale = (hi - lo) / (max_code - min_code) if hi > lo else 1.0
+        add_offset = lo - min_code * scale
+
+        codes = numpy.full(vals.shape, nan_code, dtype=dtype)
+        codes[finite] = numpy.clip(numpy.rint((vals[finite] - add_offset) / scale), min_code, max_code)
+
+        return codes.view(numpy.uint8), scale, add_offset
+
+    vals = numpy.stack(msgs, axis=-1).astype('<f4')
+    return vals.view(numpy.uint8), None, None
+
+
+def alignment(encoding: str) -> int:
+    """
+    :return: Size of each individual value of the encoding. Bands are laid out in order of decreasing
+             alignment so that every value is naturally aligned.
+    """
+    if encoding in _SCALED:
+        return _SCALED[encoding][0].itemsize
+    if encoding == BOOL:
+        return 1
+    return 4
+
+
+class Decoder(object):
+    """
+    Decodes the values of a set of bands which all have the same encoding out of location chunks.
+    Everything which doesn't depend on the chunk itself is precomputed, so decoding each chunk is
+    just a few vectorized operations.
+    """
+    encoding: str
+
+    def __init__(
+            self,
+            encoding: str,
+            offsets: List[int],
+            vals_per_locs: List[int],
+            scales: List[Optional[float]],
+            add_offsets: List[Optional[float]],
+    ):
+        self.encoding = encoding
+
+        lengths = numpy.array(vals_per_locs, dtype=numpy.int64)
+        # Position of each value within its band
+        within = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        starts = numpy.repeat(numpy.array(offsets, dtype=numpy.int64), lengths)
+
+        if encoding == BOOL:
+            self._byte_idxs = starts + within // 8
+            self._shifts = (7 - within % 8).astype(numpy.uint8)
+            return
+
+        if encoding in _SCALED:
+            self._dtype, self._nan_code, _, _ = _SCALED[encoding]
+            self._scales = numpy.repeat(numpy.array(scales, dtype=numpy.float64), lengths)
+            self._add_offsets = numpy.repeat(numpy.array(add_offsets, dtype=numpy.float64), lengths)
+        else:
+            self._dtype = numpy.dtype('<f4')
+
+        itemsize = self._dtype.itemsize
+        self._byte_idxs = starts + within * itemsize
+        # Values are normally aligned (see put_fields), in which case they can be gathered through a
+        # view of the whole chunk instead of byte by byte
+        self._aligned = bool((self._byte_idxs % itemsize == 0).all())
+        if self._aligned:
+            self._elem_idxs = self._byte_idxs // itemsize
+        else:
+            self._byte_idxs = self._byte_idxs[:, None] + numpy.arange(itemsize)
+
+    def __len__(self) -> int:
+        return len(self._byte_idxs)
+
+    def decode(self, chunk: bytes) -> numpy.ndarray:
+        """
+        :return: float32 values of every band, in the order the bands were given
+        """
+        if self.encoding == BOOL:
+            return ((numpy.frombuffer(chunk, dtype=numpy.uint8)[self._byte_idxs] >> self._shifts) & 1).astype(numpy.float32)
+
+        if self._aligned:
+            codes = numpy.frombuffer(chunk, dtype=self._dtype, count=len(chunk) // self._dtype.itemsize)[self._elem_idxs]
+        else:
+            codes = numpy.frombuffer(chunk, dtype=numpy.uint8)[self._byte_idxs].view(self._dtype).reshape(-1)
+
+        if self.encoding not in _SCALED:
+            return codes
+
+        vals = (codes * self._scales + self._add_offsets).astype(numpy.float32)
+        vals[codes == self._nan_code] = numpy.nan
+        return vals
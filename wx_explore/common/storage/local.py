@@ -0,0 +1,120 @@
+from typing import Iterable, List, Optional, Union
+
+import collections
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from .band_index import BandIndex
+from .stripes import StripedBackend
+
+
+class LocalMmapBackend(StripedBackend):
+    """
+    Stores file groups on the local filesystem with exactly the same layout as S3Backend
+    (`{root}/{y}/{file_name}`), reading them through memory maps.
+
+    Since all files are immutable once written, the maps of recently used files are kept
+    open so a point query is only a couple of page cache reads.
+    """
+    root: str
+    # Reads are just memcpys out of the page cache, so there's nothing to gain from
+    # either threads or reading extra data to save a read
+    read_workers: int = 1
+    max_coalesce_gap: int = 4096
+    # Max number of files to keep mapped at any one time
+    max_open_files: int = 4096
+
+    def __init__(self, root: str, band_index: Optional[BandIndex] = None):
+        super().__init__(band_index=band_index)
+
+        self.root = root
+        self._maps = collections.OrderedDict()
+        self._maps_lock = threading.Lock()
+
+    def _path(self, y: int, file_name: str) -> str:
+        return os.path.join(self.root, str(y), file_name)
+
+    def _get_map(self, y: int, file_name: str) -> mmap.mmap:
+        key = (y, file_name)
+
+        with self._maps_lock:
+            if key in self._maps:
+                self._maps.move_to_end(key)
+                return self._maps[key]
+
+        with open(self._path(y, file_name), 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with self._maps_lock:
+            self._maps[key] = m
+            while len(self._maps) > self.max_open_files:
+                # Evicted maps are closed once the last reference to them goes away
+                self._maps.popitem(last=False)
+
+        return m
+
+    def _read_range(self, y: int, file_name: str, start: int, end: int) -> bytes:
+        return self._get_map(y, file_name)[start:end]
+
+    async def _read_range_async(self, y: int, file_name: str, start: int, end: int) -> bytes:
+        # Not worth a trip through a thread
+        return self._read_range(y, file_name, start, end)
+
+    def _read_stripe(self, y: int, file_name: str) -> bytes:
+        with open(self._path(y, file_name), 'rb') as f:
+            return f.read()
+
+    def _write_stripe(self, y: int, file_name: str, data: Union[bytes, memoryview]):
+        row_dir = os.path.join(self.root, str(y))
+        os.makedirs(row_dir, exist_ok=True)
+
+        # Write then rename so readers never map a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=row_dir, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(y, file_name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _delete_file_group(self, file_name: str, n_y: int):
+        with self._maps_lock:
+            for y in range(n_y):
+                self._maps.pop((y, file_name), None)
+
+        for y in range(n_y):
+            try:
+                os.unlink(self._path(y, file_name))
+            except FileNotFoundError:
+                pass
+
+    def _find_orphans(self, known_file_names: Iterable[str]) -> List[str]:
+        to_del = []
+
+        if not os.path.isdir(self.root):
+            return to_del
+
+        for row_dir in os.scandir(self.root):
+            if not row_dir.is_dir():
+                continue
+
+            for f in os.scandir(row_dir.path):
+                # Ignore things that are new
+                if f.stat().st_mtime >= time.time() - 3 * 60 * 60:
+                    continue
+
+                if f.name not in known_file_names:
+                    to_del.append(f"{row_dir.name}/{f.name}")
+
+        return to_del
+
+    def _delete_orphans(self, keys: List[str]):
+        for key in keys:
+            try:
+                os.unlink(os.path.join(self.root, key))
+            except FileNotFoundError:
+                pass
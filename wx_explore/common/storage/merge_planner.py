@@ -0,0 +1,133 @@
+"""
+Chooses which file groups to merge together.
+
+Every file group a query touches costs it (at least) one read per row it needs, so merging
+files which are read by the same queries saves reads on every one of those queries. Merging
+costs reading every source file and writing the merged file, once.
+
+Each candidate file has the fraction of queries of its projection which read it (see
+AccessStats). A query reads a file group if it reads any of the files it was merged from, so
+merging a batch of files saves about sum(fractions) - max(fraction) reads per query.
+"""
+from typing import Any, Dict, List, NamedTuple
+
+
+class MergeCandidate(NamedTuple):
+    file: Any
+    # Bytes read plus bytes written to merge this file
+    rewrite_bytes: int
+    # Fraction of queries of the file's projection which read it
+    access: float
+
+
+class MergeBatch(NamedTuple):
+    projection: Any
+    files: List[Any]
+    # Expected number of reads saved per query of the projection
+    reads_saved: float
+    rewrite_bytes: int
+
+
+class ProjectionPlan(NamedTuple):
+    projection: Any
+    num_files: int
+    # Expected number of files read per query of the projection, before and after merging
+    reads_before: float
+    reads_after: float
+    batches: List[MergeBatch]
+
+
+# Access fraction to assume when picking files, so that files which are never read are still
+# merged eventually rather than never
+MIN_ACCESS = 0.01
+
+
+def _make_batch(projection, candidates: List[MergeCandidate]) -> MergeBatch:
+    accesses = [c.access for c in candidates]
+    return MergeBatch(
+        projection=projection,
+        files=[c.file for c in candidates],
+        reads_saved=sum(accesses) - max(accesses),
+        rewrite_bytes=sum(c.rewrite_bytes for c in candidates),
+    )
+
+
+def plan_merges(
+        candidates: Dict[Any, List[MergeCandidate]],
+        budget: int,
+        min_reads_saved: float,
+        max_batch_files: int = 50,
+) -> List[ProjectionPlan]:
+    """
+    Greedily choose batches of files to merge which save the most reads per query per byte rewritten,
+    until the rewrite budget is used up.
+    :param candidates: Dict of projection -> candidate files in that projection
+    :param budget: Max total bytes to rewrite
+    :param min_reads_saved: Don't merge batches which save fewer reads per query than this
+    :param max_batch_files: Max number of files to merge into one
+    :return: Plan for each projection, starting with those whose queries currently need the most reads
+    """
+    plans = []
+
+    for proj, proj_candidates in sorted(candidates.items(), key=lambda pair: sum(c.access for c in pair[1]), reverse=True):
+        # Cheapest reads saved first
+        ordered = sorted(proj_candidates, key=lambda c: c.rewrite_bytes / max(c.access, MIN_ACCESS))
+
+        batches = []
+        batch = []
+        for candidate in ordered:
+            if candidate.rewrite_bytes > budget:
+                continue
+
+            batch.append(candidate)
+            budget -= candidate.rewrite_bytes
+
+            if len(batch) == max_batch_files:
+                batches.append(_make_batch(proj, batch))
+                batch = []
+
+        if batch:
+            batches.append(_make_batch(proj, batch))
+
+        # Give back the budget of anything not worth doing
+        worth_it = []
+        for b in batches:
+            if b.reads_saved >= min_reads_saved:
+                worth_it.append(b)
+            else:
+                budget += b.rewrite_bytes
+
+        reads_before = sum(c.access for c in proj_candidates)
+        plans.append(ProjectionPlan(
+            projection=proj,
+            num_files=len(proj_candidates),
+            reads_before=reads_before,
+            reads_after=reads_before - sum(b.reads_saved for b in worth_it),
+            batches=worth_it,
+        ))
+
+    return plans
+
+
+def describe_plan(plans: List[ProjectionPlan]) -> str:
+    """
+    Human readable summary of a merge plan and its predicted savings
+    """
+    lines = []
+    total_bytes = 0
+
+    for plan in plans:
+        rewrite_bytes = sum(b.rewrite_bytes for b in plan.batches)
+        total_bytes += rewrite_bytes
+
+        lines.append(
+            f"Projection {plan.projection.id}: {plan.num_files} files, "
+            f"{plan.reads_before:.1f} -> {plan.reads_after:.1f} reads/query/row, "
+            f"{len(plan.batches)} merges rewriting {rewrite_bytes / 1e9:.2f} GB"
+        )
+        for b in plan.batches:
+            lines.append(f"  {len(b.files)} files, saves {b.reads_saved:.1f} reads/query/row, rewrites {b.rewrite_bytes / 1e9:.2f} GB")
+
+    lines.append(f"Total: {total_bytes / 1e9:.2f} GB rewritten")
+
+    return '\n'.join(lines)
@@ -121,7 +121,7 @@ class MongoBackend(DataProvider):
         with tracing.start_span('put_fields saving') as span:
             self.collection.insert_many(rows.values())
 
-    def clean(self, oldest_time: datetime.datetime):
+    def clean(self, oldest_time: datetime.datetime, scan_orphans: bool = False):
         for proj in Projection.query.all():
             self.collection.remove({
                 'proj_id': proj.id,
@@ -0,0 +1,98 @@
+"""
+Compressed ("blocked") stripe format.
+
+A raw stripe is just `n_x` back-to-back location chunks. A blocked stripe instead groups
+the locations into blocks of `block_size` locations which are each compressed independently,
+so that reading a single location only needs its block:
+
+    magic (4 bytes)
+    uint64 offsets[n_blocks + 1]: offset of each block within the stripe (the last is the end of the stripe)
+    block 0
+    block 1
+    ...
+
+The header size only depends on n_x and block_size, so it can be range read (and cached) on its own.
+
+Within a block, location chunks are byte shuffled before being zlib compressed: the first byte of
+every location's chunk, then the second byte of every location's chunk, etc. This puts each byte of
+each value of a band (whatever its encoding, see encoding.py) next to the same byte of the neighboring
+locations, which tend to have very similar values, so this compresses much better than compressing
+location chunks as-is.
+"""
+import zlib
+
+import numpy
+
+MAGIC = b'WXB2'
+
+# zlib compression level. Higher levels are much slower to write for little gain on this kind of data.
+COMPRESSION_LEVEL = 1
+
+
+def num_blocks(n_x: int, block_size: int) -> int:
+    return -(-n_x // block_size)
+
+
+def header_size(n_x: int, block_size: int) -> int:
+    return len(MAGIC) + 8 * (num_blocks(n_x, block_size) + 1)
+
+
+def encode_block(chunks: numpy.ndarray) -> bytes:
+    """
+    :param chunks: (n_locs, loc_size) uint8 array
+    """
+    return zlib.compress(numpy.ascontiguousarray(chunks.T), COMPRESSION_LEVEL)
+
+
+def decode_block(data: bytes, loc_size: int) -> numpy.ndarray:
+    """
+    :return: (n_locs, loc_size) uint8 array
+    """
+    raw = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8)
+    if len(raw) % loc_size != 0:
+        raise ValueError(f"Invalid block size {len(raw)} for location size {loc_size}")
+
+    return numpy.ascontiguousarray(raw.reshape(loc_size, -1).T)
+
+
+def encode_stripe(values: numpy.ndarray, block_size: int) -> bytes:
+    """
+    :param values: (n_x, loc_size) uint8 array of location chunks
+    """
+    n_x = values.shape[0]
+    blocks = [encode_block(values[start:start+block_size]) for start in range(0, n_x, block_size)]
+
+    offsets = numpy.cumsum([header_size(n_x, block_size)] + [len(block) for block in blocks], dtype='<u8')
+
+    return b''.join([MAGIC, offsets.tobytes()] + blocks)
+
+
+def parse_header(data: bytes, n_x: int, block_size: int) -> numpy.ndarray:
+    """
+    :param data: At least the first header_size(n_x, block_size) bytes of a stripe
+    :return: Offsets of each block (plus the end of the stripe)
+    """
+    size = header_size(n_x, block_size)
+    if len(data) < size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Invalid blocked stripe header")
+
+    return numpy.frombuffer(data, dtype='<u8', count=num_blocks(n_x, block_size) + 1, offset=len(MAGIC)).astype(numpy.int64)
+
+
+def decode_stripe(data: bytes, n_x: int, block_size: int, loc_size: int) -> numpy.ndarray:
+    """
+    :return: (n_x, loc_size) uint8 array of location chunks
+    """
+    offsets = parse_header(data, n_x, block_size)
+    if offsets[-1] != len(data):
+        raise ValueError(f"Invalid stripe size. Expected {offsets[-1]}, got {len(data)}")
+
+    values = numpy.concatenate([
+        decode_block(data[start:end], loc_size)
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ])
+
+    if values.shape[0] != n_x:
+        raise ValueError(f"Invalid number of locations in stripe. Expected {n_x}, got {values.shape[0]}")
+
+    return values
@@ -0,0 +1,962 @@
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
+from typing import Iterable, List, Dict, Optional, Tuple, Union
+
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import logging
+import numpy
+import queue
+import random
+import time
+
+from . import DataProvider, encoding, merge_planner, stripe_format
+from .band_index import Band, BandFile, BandIndex, notify_bands_changed
+from .access_stats import AccessStats, load_access_fractions
+from .cache import ChunkCache
+from wx_explore.common import tracing
+from wx_explore.common.config import Config
+from wx_explore.common.db_utils import ensure_band_partitions, run_db_async
+from wx_explore.common.location import clear_proj_cache
+from wx_explore.common.utils import chunk, run_in_thread
+from wx_explore.common.models import (
+    Projection,
+    SourceField,
+    FileMeta,
+    FileBandMeta,
+    FileAccessStats,
+    MergeCheckpoint,
+    DataPointSet,
+    DataPointBatch,
+)
+from wx_explore.web.core import db
+
+
+class StripedBackend(DataProvider):
+    """
+    Base for backends which store data denormalized by location in "file groups".
+
+    Each file group holds any number of bands (all with the same projection) and is
+    stored as one object/file per grid row, named `{y}/{file_name}`. Each row is
+    `n_x` back-to-back location chunks of `loc_size` bytes, and each location chunk
+    holds the values of every band in the file group (see FileBandMeta.offset), each
+    in its metric's encoding (see encoding.py).
+    This means loading all data for a single location from a file group is a single
+    range read of `loc_size` bytes.
+
+    Rows can instead be stored compressed in blocks of `block_size` locations (see stripe_format),
+    in which case loading a location is a read of the row's (cacheable) header and of its block.
+
+    Subclasses only need to implement the raw storage operations.
+    """
+    logger: logging.Logger
+    # Max number of unneeded bytes to read between two locations in the same row to
+    # be able to fetch both with a single read
+    max_coalesce_gap: int = 256 * 1024
+    # Number of reads to do in parallel when loading fields. 1 means reads are done inline.
+    read_workers: int = 32
+    # Number of rows to write in parallel when creating a file group
+    write_workers: int = 32
+    # Number of file groups to delete in parallel when cleaning
+    delete_workers: int = 16
+    # Max number of rows to merge in parallel (also limited by Config.MERGE_MEMORY_BYTES), and number of
+    # source rows to load in parallel (shared by all rows being merged)
+    merge_row_workers: int = 16
+    merge_load_workers: int = 32
+    # Number of times to try to merge a set of files before giving up on it
+    merge_max_attempts: int = 3
+    # Cache of location chunks read by queries, keyed by (file_name, y, x), and blocked row headers, keyed by (file_name, y, 'header')
+    chunk_cache: Optional[ChunkCache]
+    # In-memory copy of all band metadata, so queries don't need to go to the DB
+    band_index: BandIndex
+    # Number of locations per compressed block in newly written file groups, or 0 to write raw rows
+    block_size: int
+    # Counts of which files queries read, for the merge planner
+    access_stats: Optional[AccessStats]
+
+    def __init__(
+            self,
+            chunk_cache: Optional[ChunkCache] = None,
+            band_index: Optional[BandIndex] = None,
+            block_size: int = 0,
+            access_stats: Optional[AccessStats] = None,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.chunk_cache = chunk_cache
+        self.band_index = band_index if band_index is not None else BandIndex()
+        self.block_size = block_size
+        self.access_stats = access_stats
+
+    ###
+    # Storage operations
+    ###
+
+    def _read_range(self, y: int, file_name: str, start: int, end: int) -> bytes:
+        """
+        Read bytes [start, end) of row y of the given file group
+        """
+        raise NotImplementedError()
+
+    def _read_stripe(self, y: int, file_name: str) -> bytes:
+        """
+        Read all of row y of the given file group
+        """
+        raise NotImplementedError()
+
+    def _write_stripe(self, y: int, file_name: str, data: Union[bytes, memoryview]):
+        """
+        Write all of row y of the given file group. data may be a view into a larger buffer.
+        """
+        raise NotImplementedError()
+
+    def _write_values(self, y: int, file_name: str, values: numpy.ndarray, block_size: Optional[int]) -> int:
+        """
+        Write row y of the given file group from its (n_x, loc_size) uint8 array of location chunks
+        :param block_size: Number of locations per compressed block of the file group, or None if it is raw
+        :return: Number of bytes written
+        """
+        if block_size:
+            data = stripe_format.encode_stripe(values, block_size)
+        else:
+            data = memoryview(values).cast('B')
+
+        self._write_stripe(y, file_name, data)
+        return len(data)
+
+    async def _read_range_async(self, y: int, file_name: str, start: int, end: int) -> bytes:
+        """
+        Async version of _read_range. Defaults to doing the read on a thread.
+        """
+        return await run_in_thread(self._read_range, y, file_name, start, end)
+
+    def _delete_file_group(self, file_name: str, n_y: int):
+        raise NotImplementedError()
+
+    def _find_orphans(self, known_file_names: Iterable[str]) -> List[str]:
+        """
+        Find all stored rows which don't belong to any of the given file groups
+        :return: List of row keys (`{y}/{file_name}`)
+        """
+        raise NotImplementedError()
+
+    def _delete_orphans(self, keys: List[str]):
+        raise NotImplementedError()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters about this backend's storage operations, for monitoring
+        """
+        if self.chunk_cache is not None:
+            return self.chunk_cache.stats()
+        return {}
+
+    ###
+    # Reading
+    ###
+
+    def load_file_chunk(self, fm, coords):
+        x, y = coords
+        return self.load_file_chunks(fm, y, [x])[x]
+
+    def _coalesce_reads(self, fm, header, xs) -> List[Tuple[int, int]]:
+        """
+        Group the given x's into runs which can each be read at once without reading too much unneeded
+        data in between. Runs are (first x, last x) for raw stripes, or (first block, last block) for
+        blocked stripes.
+        :param header: Block offsets of the stripe if it is blocked, otherwise None
+        """
+        if header is None:
+            # For raw stripes each x is its own "block"
+            units = sorted(set(xs))
+            unit_start = lambda unit: unit * fm.loc_size
+        else:
+            units = sorted(set(x // fm.block_size for x in xs))
+            unit_start = lambda block: header[block]
+
+        runs = [[units[0], units[0]]]
+        for unit in units[1:]:
+            if unit_start(unit) - unit_start(runs[-1][1] + 1) <= self.max_coalesce_gap:
+                runs[-1][1] = unit
+            else:
+                runs.append([unit, unit])
+
+        return [(run_start, run_end) for run_start, run_end in runs]
+
+    @staticmethod
+    def _run_range(fm, header, run) -> Tuple[int, int]:
+        """
+        :return: Byte range [start, end) of the stripe holding the given run
+        """
+        run_start, run_end = run
+        if header is None:
+            return run_start * fm.loc_size, (run_end + 1) * fm.loc_size
+        return int(header[run_start]), int(header[run_end + 1])
+
+    @staticmethod
+    def _split_run(fm, header, run, content, xs, chunks):
+        """
+        Split the content read for the given run into the chunks for each of xs in it
+        """
+        run_start, run_end = run
+
+        if header is None:
+            for x in xs:
+                if run_start <= x <= run_end:
+                    rel = (x - run_start) * fm.loc_size
+                    chunks[x] = content[rel:rel+fm.loc_size]
+            return
+
+        block_xs = collections.defaultdict(list)
+        for x in xs:
+            if run_start <= x // fm.block_size <= run_end:
+                block_xs[x // fm.block_size].append(x)
+
+        for block, xs_in_block in block_xs.items():
+            rel_start = header[block] - header[run_start]
+            rel_end = header[block + 1] - header[run_start]
+            values = stripe_format.decode_block(content[rel_start:rel_end], fm.loc_size)
+
+            for x in xs_in_block:
+                chunks[x] = values[x - block * fm.block_size].tobytes()
+
+    def _get_cached_header(self, fm, y) -> Optional[numpy.ndarray]:
+        if self.chunk_cache is None:
+            return None
+
+        data = self.chunk_cache.get((fm.file_name, y, 'header'))
+        if data is None:
+            return None
+
+        return stripe_format.parse_header(data, fm.n_x, fm.block_size)
+
+    def _cache_header(self, fm, y, data: bytes) -> numpy.ndarray:
+        header = stripe_format.parse_header(data, fm.n_x, fm.block_size)
+
+        if self.chunk_cache is not None:
+            self.chunk_cache.put((fm.file_name, y, 'header'), data)
+
+        return header
+
+    def _load_header(self, fm, y) -> Optional[numpy.ndarray]:
+        """
+        :return: Block offsets of row y of the given file if it is blocked, otherwise None
+        """
+        if not fm.block_size:
+            return None
+
+        header = self._get_cached_header(fm, y)
+        if header is None:
+            header = self._cache_header(fm, y, self._read_range(y, fm.file_name, 0, stripe_format.header_size(fm.n_x, fm.block_size)))
+
+        return header
+
+    async def _load_header_async(self, fm, y) -> Optional[numpy.ndarray]:
+        if not fm.block_size:
+            return None
+
+        header = self._get_cached_header(fm, y)
+        if header is None:
+            header = self._cache_header(fm, y, await self._read_range_async(y, fm.file_name, 0, stripe_format.header_size(fm.n_x, fm.block_size)))
+
+        return header
+
+    def _get_cached_chunks(self, fm, y, xs):
+        """
+        :return: Dict of x -> chunk for all of xs which are in the chunk cache, and a list of the xs which aren't
+        """
+        if self.chunk_cache is None:
+            return {}, list(xs)
+
+        chunks = {}
+        missing = []
+        for x in xs:
+            content = self.chunk_cache.get((fm.file_name, y, x))
+            if content is None:
+                missing.append(x)
+            else:
+                chunks[x] = content
+
+        return chunks, missing
+
+    def _cache_chunks(self, fm, y, chunks):
+        if self.chunk_cache is None:
+            return
+
+        for x, content in chunks.items():
+            self.chunk_cache.put((fm.file_name, y, x), content)
+
+    def load_file_chunks(self, fm, y, xs):
+        """
+        Loads the chunks for all of xs in row y of the given file, coalescing nearby x's into a single range read.
+        :return: Dict of x -> chunk
+        """
+        chunks, missing = self._get_cached_chunks(fm, y, xs)
+        if not missing:
+            return chunks
+
+        header = self._load_header(fm, y)
+
+        loaded = {}
+        for run in self._coalesce_reads(fm, header, missing):
+            content = self._read_range(y, fm.file_name, *self._run_range(fm, header, run))
+            self._split_run(fm, header, run, content, missing, loaded)
+
+        self._cache_chunks(fm, y, loaded)
+        chunks.update(loaded)
+
+        return chunks
+
+    async def load_file_chunks_async(self, fm, y, xs):
+        """
+        Async version of load_file_chunks. All runs are read concurrently.
+        """
+        chunks, missing = self._get_cached_chunks(fm, y, xs)
+        if not missing:
+            return chunks
+
+        header = await self._load_header_async(fm, y)
+
+        runs = self._coalesce_reads(fm, header, missing)
+        contents = await asyncio.gather(*(
+            self._read_range_async(y, fm.file_name, *self._run_range(fm, header, run))
+            for run in runs
+        ))
+
+        loaded = {}
+        for run, content in zip(runs, contents):
+            self._split_run(fm, header, run, content, missing, loaded)
+
+        self._cache_chunks(fm, y, loaded)
+        chunks.update(loaded)
+
+        return chunks
+
+    def _load_band_metas(
+            self,
+            proj_id: int,
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> List[Band]:
+        with tracing.start_span("load file band metas") as span:
+            bands = self.band_index.query(proj_id, [sf.id for sf in valid_source_fields], start, end)
+            span.set_attribute("num_bands", len(bands))
+            return bands
+
+    @staticmethod
+    def _plan_reads(bands: List[Band], locs: List[Tuple[int, int]]):
+        """
+        :return: List of (BandFile, y, xs) reads needed to get every band for every loc
+        """
+        # Gather all files we need data from
+        file_metas = set(band.file for band in bands)
+
+        # All x's needed for each y
+        row_xs = collections.defaultdict(set)
+        for x, y in locs:
+            row_xs[y].add(x)
+
+        return [(fm, y, xs) for fm in file_metas for y, xs in row_xs.items()]
+
+    @staticmethod
+    def _make_decoders(bands: List[Band], offsets: numpy.ndarray) -> Dict[str, List[Tuple[encoding.Decoder, numpy.ndarray]]]:
+        """
+        :return: Dict of file name -> [(decoder for all bands in that file with a given encoding,
+                 index in the output values each decoded value goes to), ...]
+        """
+        file_bands = collections.defaultdict(lambda: collections.defaultdict(list))
+        for i, band in enumerate(bands):
+            file_bands[band.file.file_name][band.encoding].append(i)
+
+        decoders = collections.defaultdict(list)
+        for file_name, encoding_bands in file_bands.items():
+            for band_encoding, band_idxs in encoding_bands.items():
+                band_idxs = numpy.array(band_idxs)
+                lengths = offsets[band_idxs + 1] - offsets[band_idxs]
+
+                decoder = encoding.Decoder(
+                    band_encoding,
+                    [bands[i].offset for i in band_idxs],
+                    [bands[i].vals_per_loc for i in band_idxs],
+                    [bands[i].scale for i in band_idxs],
+                    [bands[i].add_offset for i in band_idxs],
+                )
+
+                # Position of each value within its band
+                within = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+                decoders[file_name].append((decoder, numpy.repeat(offsets[band_idxs], lengths) + within))
+
+        return decoders
+
+    @classmethod
+    def _decode_fields(
+            cls,
+            bands: List[Band],
+            valid_source_fields: List[SourceField],
+            reads,
+            results,
+            locs: List[Tuple[int, int]],
+    ) -> List[DataPointBatch]:
+        metric_ids = {sf.id: sf.metric_id for sf in valid_source_fields}
+
+        # (file name, x, y) -> chunk
+        file_contents = {}
+        for (fm, y, _), chunks in zip(reads, results):
+            for x, content in chunks.items():
+                file_contents[(fm.file_name, x, y)] = content
+
+        # Every loc has the same bands, so the metadata arrays are shared by all of them
+        valid_time = numpy.array([band.valid_time for band in bands], dtype='datetime64[us]')
+        metric_id = numpy.array([metric_ids[band.source_field_id] for band in bands], dtype=numpy.int64)
+        source_field_id = numpy.array([band.source_field_id for band in bands], dtype=numpy.int64)
+        run_time = numpy.array([band.run_time for band in bands], dtype='datetime64[us]')
+        offsets = numpy.concatenate([[0], numpy.cumsum([band.vals_per_loc for band in bands], dtype=numpy.int64)])
+
+        decoders = cls._make_decoders(bands, offsets)
+
+        # For each loc, decode the values of all bands in each file straight out of the chunk
+        batches = []
+        for x, y in locs:
+            values = numpy.empty(offsets[-1], dtype=numpy.float32)
+            for file_name, file_decoders in decoders.items():
+                content = file_contents[(file_name, x, y)]
+                for decoder, dst_idxs in file_decoders:
+                    values[dst_idxs] = decoder.decode(content)
+
+            batches.append(DataPointBatch(
+                valid_time=valid_time,
+                metric_id=metric_id,
+                values=values,
+                offsets=offsets,
+                source_field_id=source_field_id,
+                run_time=run_time,
+            ))
+
+        return batches
+
+    def get_fields(
+            self,
+            proj_id: int,
+            loc: Tuple[float, float],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> List[DataPointSet]:
+        return self.get_fields_many(proj_id, [loc], valid_source_fields, start, end)[0].to_data_points()
+
+    def get_fields_many(
+            self,
+            proj_id: int,
+            locs: List[Tuple[int, int]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> List[DataPointBatch]:
+        bands = self._load_band_metas(proj_id, valid_source_fields, start, end)
+        reads = self._plan_reads(bands, locs)
+
+        if self.access_stats is not None:
+            self.access_stats.record(proj_id, (band.file.file_name for band in bands))
+
+        # Read them in (in parallel), one task per file row
+        with tracing.start_span("load file chunks") as span:
+            span.set_attribute("num_reads", len(reads))
+
+            if self.read_workers > 1:
+                with concurrent.futures.ThreadPoolExecutor(self.read_workers) as executor:
+                    results = list(executor.map(lambda read: self.load_file_chunks(*read), reads))
+            else:
+                results = [self.load_file_chunks(*read) for read in reads]
+
+            span.set_attribute("stats", str(self.stats()))
+
+        return self._decode_fields(bands, valid_source_fields, reads, results, locs)
+
+    async def get_fields_many_async(
+            self,
+            proj_id: int,
+            locs: List[Tuple[int, int]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> List[DataPointBatch]:
+        bands = await run_db_async(self._load_band_metas, proj_id, valid_source_fields, start, end)
+        reads = self._plan_reads(bands, locs)
+
+        if self.access_stats is not None:
+            self.access_stats.record(proj_id, (band.file.file_name for band in bands))
+
+        with tracing.start_span("load file chunks") as span:
+            span.set_attribute("num_reads", len(reads))
+
+            results = await asyncio.gather(*(self.load_file_chunks_async(*read) for read in reads))
+
+            span.set_attribute("stats", str(self.stats()))
+
+        return self._decode_fields(bands, valid_source_fields, reads, results, locs)
+
+    ###
+    # Writing
+    ###
+
+    def put_fields(
+            self,
+            proj: Projection,
+            fields: Dict[Tuple[int, datetime.datetime, datetime.datetime], List[numpy.array]]
+    ):
+        # fields is map of (field_id, valid_time, run_time) -> [msg, ...]
+        metas = []
+
+        file_name = ''.join(random.choices('0123456789abcdef', k=32))
+
+        fm = FileMeta(
+            file_name=file_name,
+            projection_id=proj.id,
+            block_size=self.block_size or None,
+        )
+        db.session.add(fm)
+
+        field_encodings = {
+            sf.id: encoding.get_encoding(sf.metric.encoding)
+            for sf in SourceField.query.filter(SourceField.id.in_([field_id for field_id, _, _ in fields.keys()])).all()
+        }
+
+        # Bands are laid out in order of decreasing alignment so that every value is naturally aligned
+        keys = sorted(fields.keys(), key=lambda k: -encoding.alignment(field_encodings[k[0]]))
+        sizes = [encoding.value_size(field_encodings[k[0]], len(fields[k])) for k in keys]
+
+        # The whole file group is built in place in its final (row, location chunk) layout,
+        # so each row can be written straight out of it without any intermediate copies.
+        n_y, n_x = proj.shape()
+        combined = numpy.empty((n_y, n_x, sum(sizes)), dtype=numpy.uint8)
+
+        offset = 0
+        for (field_id, valid_time, run_time), size in zip(keys, sizes):
+            msgs = fields[(field_id, valid_time, run_time)]
+            for msg in msgs:
+                if msg.shape != (n_y, n_x):
+                    raise ValueError(f"Field {field_id} has shape {msg.shape}, expected {(n_y, n_x)}")
+
+            codes, scale, add_offset = encoding.encode(field_encodings[field_id], msgs)
+            combined[:, :, offset:offset+size] = codes
+
+            metas.append(dict(
+                file_name=file_name,
+                source_field_id=field_id,
+                valid_time=valid_time,
+                run_time=run_time,
+                offset=offset,
+                vals_per_loc=len(msgs),
+                encoding=field_encodings[field_id],
+                scale=scale,
+                add_offset=add_offset,
+            ))
+
+            offset += size
+
+        fm.loc_size = offset
+
+        # The file group is tracked before anything is written, so that if writing fails or
+        # is interrupted, the cleaner will find (and remove) it without having to list storage.
+        db.session.commit()
+
+        self.logger.info("Creating file group %s (%d bands, %d bytes)", file_name, len(keys), combined.nbytes)
+
+        with concurrent.futures.ThreadPoolExecutor(self.write_workers) as executor:
+            futures = concurrent.futures.wait([
+                executor.submit(self._write_values, y, file_name, row, fm.block_size)
+                for y, row in enumerate(combined)
+            ])
+            errors = [fut.exception() for fut in futures.done if fut.exception() is not None]
+
+        # Bands must never point at rows which weren't written. The file group's FileMeta (without any
+        # bands) is left for the cleaner to remove, and the caller can retry.
+        if errors:
+            self.logger.warning("%d of %d rows of %s failed to write: %s", len(errors), len(combined), file_name, errors[0])
+            raise Exception(f"Unable to create file group {file_name}") from errors[0]
+
+        # All bands are inserted with a single statement (in the same transaction as the notification)
+        # instead of one ORM insert per band
+        with tracing.start_span('save file band metas') as span:
+            span.set_attribute('num_bands', len(metas))
+            # Bands inserted into the default partition would keep their day from getting a partition
+            ensure_band_partitions(min(valid_time for _, valid_time, _ in keys), max(valid_time for _, valid_time, _ in keys))
+            db.session.execute(insert(FileBandMeta).values(metas).on_conflict_do_nothing())
+            notify_bands_changed(proj.id, file_name)
+            db.session.commit()
+
+        self.logger.info("Storage stats: %s", self.stats())
+
+    ###
+    # Cleaning
+    ###
+
+    def clean(self, _oldest_time: datetime.datetime, scan_orphans: bool = False):
+        # Every file group is tracked by a FileMeta before it's written, so file groups
+        # without any bands are either unused or never finished being created.
+        files = FileMeta.query.filter(
+            ~FileBandMeta.query.filter(FileBandMeta.file_name == FileMeta.file_name).exists(),
+            FileMeta.file_name.notin_(MergeCheckpoint.query.with_entities(MergeCheckpoint.file_name)),  # being merged into
+            FileMeta.ctime <= datetime.datetime.utcnow() - datetime.timedelta(hours=1),  # make sure we don't delete files being populated right now
+        ).all()
+
+        self.logger.info("Removing %d unused file groups", len(files))
+
+        with concurrent.futures.ThreadPoolExecutor(self.delete_workers) as executor:
+            futures = {
+                executor.submit(self._delete_file_group, f.file_name, f.projection.n_y): f.file_name
+                for f in files
+            }
+
+            deleted = []
+            for fut in concurrent.futures.as_completed(futures):
+                if fut.exception() is not None:
+                    self.logger.warning("Unable to remove file group %s: %s", futures[fut], fut.exception())
+                else:
+                    deleted.append(futures[fut])
+
+        for names in chunk(deleted, 1000):
+            FileAccessStats.query.filter(FileAccessStats.file_name.in_(names)).delete(synchronize_session=False)
+            FileMeta.query.filter(FileMeta.file_name.in_(names)).delete(synchronize_session=False)
+            db.session.commit()
+
+        if not scan_orphans:
+            return
+
+        # Look for any stored files which aren't tracked by a FileMeta. This shouldn't be possible
+        # since file groups are tracked before they're written, but is worth checking for every so often
+        # to prevent storage usage from growing unbounded. This has to list all of storage so is slow.
+        self.logger.info("Finding orphaned files to remove...")
+        known_fns = set(fn for fn, in FileMeta.query.with_entities(FileMeta.file_name).all())
+        to_del = self._find_orphans(known_fns)
+
+        self.logger.info("Removing %d orphaned files", len(to_del))
+        self._delete_orphans(to_del)
+
+        FileAccessStats.query.filter(
+            FileAccessStats.file_name.notin_(FileMeta.query.with_entities(FileMeta.file_name)),
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    ###
+    # Merging
+    ###
+
+    def _load_stripe(self, y: int, n_x: int, f: BandFile) -> Tuple[numpy.ndarray, int]:
+        """
+        :return: (n_x, loc_size) uint8 array of the location chunks of row y of the given file, and the number of bytes read
+        """
+        stripe = self._read_stripe(y, f.file_name)
+
+        if f.block_size:
+            return stripe_format.decode_stripe(stripe, n_x, f.block_size, f.loc_size), len(stripe)
+
+        if len(stripe) != n_x * f.loc_size:
+            raise ValueError(f"Invalid file size in {y}/{f.file_name}. Expected {n_x*f.loc_size}, got {len(stripe)}")
+
+        return numpy.frombuffer(stripe, dtype=numpy.uint8).reshape((n_x, f.loc_size)), len(stripe)
+
+    def _load_stripe_into(self, merged: numpy.ndarray, idxs: Tuple[numpy.ndarray, numpy.ndarray], y: int, f: BandFile) -> int:
+        """
+        Load row y of the given file and copy its used values into their place in the merged row
+        :return: Number of bytes read
+        """
+        datas, nbytes = self._load_stripe(y, merged.shape[0], f)
+        src_idxs, dst_idxs = idxs
+        merged[:, dst_idxs] = datas[:, src_idxs]
+        return nbytes
+
+    def _create_merged_stripe(self, files, used_idxs, file_name, block_size, y, buffers, load_executor, trace_span) -> Tuple[int, int]:
+        """
+        Create row y of the merged file using one of the row buffers
+        :return: Number of bytes read and written
+        """
+        merged = buffers.get()
+        try:
+            with tracing.start_span('stripe loading', parent=trace_span):
+                read = sum(fut.result() for fut in [
+                    load_executor.submit(self._load_stripe_into, merged, used_idxs[f], y, f)
+                    for f in files
+                ])
+
+            with tracing.start_span('merged stripe save', parent=trace_span):
+                written = self._write_values(y, file_name, merged, block_size)
+        finally:
+            buffers.put(merged)
+
+        return read, written
+
+    @staticmethod
+    def _stripe_memory(f: BandFile) -> int:
+        """
+        Max memory needed to load a row of the given file
+        """
+        raw = f.n_x * f.loc_size
+        # Blocked rows are held both compressed and decompressed
+        return raw * 2 if f.block_size else raw
+
+    def _plan_merge(self, files: List[FileMeta]) -> List[Tuple[str, int, int, int]]:
+        """
+        Figure out what is still used in each file so that the merge process can effectively
+        garbage collect unused data, and where it goes in the merged file.
+        :return: [(source file name, source offset, size, merged offset), ...] for every band to merge
+        """
+        # Don't bother merging old data. Prevents racing with the cleaner,
+        # and probably won't be queried anyways.
+        live_bands = [
+            band
+            for f in files
+            for band in f.bands
+            if band.valid_time >= datetime.datetime.utcnow()
+        ]
+        # Keep every value naturally aligned (see put_fields)
+        live_bands.sort(key=lambda band: -encoding.alignment(encoding.get_encoding(band.encoding)))
+
+        plan = []
+        offset = 0
+        for band in live_bands:
+            size = encoding.value_size(encoding.get_encoding(band.encoding), band.vals_per_loc)
+            plan.append((band.file_name, band.offset, size, offset))
+            offset += size
+
+        return plan
+
+    def _start_merge(self, proj: Projection, files: List[FileMeta]):
+        plan = self._plan_merge(files)
+        if not plan:
+            return
+
+        # Random (rather than derived from the source files) so that retrying files from an abandoned merge never collides with it
+        file_name = ''.join(random.choices('0123456789abcdef', k=32))
+
+        self.logger.info("Merging %s into %s", ','.join(f.file_name for f in files), file_name)
+
+        # The merged file is tracked (and checkpointed) before anything is written, so that if
+        # this is interrupted the merge can be resumed (or if it's abandoned, removed).
+        merged_meta = FileMeta(
+            file_name=file_name,
+            projection_id=proj.id,
+            loc_size=sum(size for _, _, size, _ in plan),
+            block_size=self.block_size or None,
+        )
+        checkpoint = MergeCheckpoint(
+            file_name=file_name,
+            plan=plan,
+            rows_done=[],
+            attempts=0,
+        )
+        db.session.add(merged_meta)
+        db.session.add(checkpoint)
+        db.session.commit()
+
+        self._run_merge(proj, checkpoint)
+
+    def _abandon_merge(self, proj: Projection, checkpoint: MergeCheckpoint):
+        """
+        Give up on a merge, removing everything of the merged file (which has no bands yet)
+        """
+        merged_meta = checkpoint.merged_file
+        db.session.delete(checkpoint)
+
+        try:
+            self._delete_file_group(merged_meta.file_name, proj.n_y)
+        except Exception:
+            # The cleaner will get it eventually
+            self.logger.exception("Unable to remove abandoned merged file group %s", merged_meta.file_name)
+        else:
+            db.session.delete(merged_meta)
+
+        db.session.commit()
+
+    def _run_merge(self, proj: Projection, checkpoint: MergeCheckpoint):
+        """
+        Create all rows of the checkpoint's merged file which haven't been created yet, streaming them
+        through a fixed pool of row buffers so memory use is bounded by Config.MERGE_MEMORY_BYTES.
+        Once every row is created, the merged bands are moved to the merged file.
+        """
+        merged_meta = checkpoint.merged_file
+        file_name = merged_meta.file_name
+        block_size = merged_meta.block_size
+        n_y, n_x = proj.shape()
+        source_names = checkpoint.source_file_names()
+
+        source_metas = FileMeta.query.filter(FileMeta.file_name.in_(source_names)).all()
+        if len(source_metas) != len(source_names):
+            self.logger.warning("Source files of %s have been removed. Abandoning merge", file_name)
+            self._abandon_merge(proj, checkpoint)
+            return
+
+        if checkpoint.attempts >= self.merge_max_attempts:
+            self.logger.error("Merging %s failed %d times. Abandoning merge", file_name, checkpoint.attempts)
+            self._abandon_merge(proj, checkpoint)
+            return
+
+        checkpoint.attempts += 1
+        db.session.commit()
+
+        # Plain copies of everything row creation needs, since it happens on other threads
+        files = [BandFile(f.file_name, f.loc_size, f.block_size, n_x) for f in source_metas]
+        plan = checkpoint.plan
+        loc_size = merged_meta.loc_size
+        rows_done = set(checkpoint.rows_done)
+
+        src_idxs = collections.defaultdict(list)
+        dst_idxs = collections.defaultdict(list)
+        for src, src_offset, size, merged_offset in plan:
+            src_idxs[src].extend(range(src_offset, src_offset + size))
+            dst_idxs[src].extend(range(merged_offset, merged_offset + size))
+
+        used_idxs = {
+            f: (numpy.array(src_idxs[f.file_name], dtype=numpy.int64), numpy.array(dst_idxs[f.file_name], dtype=numpy.int64))
+            for f in files
+        }
+
+        # Memory accounting: every load in flight holds one source row, and every row being
+        # created holds one row buffer (plus its encoded copy if blocked). Loads get whatever
+        # fits after reserving one row buffer, and row buffers get whatever is left after that
+        # (but there's always at least one of each).
+        row_memory = n_x * loc_size * (2 if block_size else 1)
+        max_load_memory = max(self._stripe_memory(f) for f in files)
+        n_loads = max(1, min(self.merge_load_workers, (Config.MERGE_MEMORY_BYTES - row_memory) // max_load_memory))
+        n_buffers = max(1, min(self.merge_row_workers, (Config.MERGE_MEMORY_BYTES - n_loads * max_load_memory) // row_memory))
+
+        self.logger.info(
+            "Merge memory: %d row buffers of %d bytes + %d loads of up to %d bytes (budget %d)",
+            n_buffers, row_memory, n_loads, max_load_memory, Config.MERGE_MEMORY_BYTES,
+        )
+        if n_buffers * row_memory + n_loads * max_load_memory > Config.MERGE_MEMORY_BYTES:
+            self.logger.warning("Merging a single row needs more memory than the merge budget")
+
+        buffers = queue.Queue()
+        for _ in range(n_buffers):
+            buffers.put(numpy.empty((n_x, loc_size), dtype=numpy.uint8))
+
+        rows = [y for y in range(n_y) if y not in rows_done]
+        failed = False
+        merged_rows = read = written = 0
+        start = time.monotonic()
+        last_checkpoint = start
+
+        with tracing.start_span('parallel stripe creation') as span:
+            span.set_attribute("file_name", file_name)
+            span.set_attribute("num_files", len(files))
+            span.set_attribute("num_rows", len(rows))
+            span.set_attribute("resumed_rows", len(rows_done))
+
+            with concurrent.futures.ThreadPoolExecutor(n_loads) as load_executor, \
+                    concurrent.futures.ThreadPoolExecutor(n_buffers) as row_executor:
+                futures = {
+                    row_executor.submit(self._create_merged_stripe, files, used_idxs, file_name, block_size, y, buffers, load_executor, span): y
+                    for y in rows
+                }
+
+                for fut in concurrent.futures.as_completed(futures):
+                    if fut.exception() is not None:
+                        self.logger.error("Exception merging row %d: %s", futures[fut], fut.exception())
+                        failed = True
+                        continue
+
+                    row_read, row_written = fut.result()
+                    merged_rows += 1
+                    read += row_read
+                    written += row_written
+                    rows_done.add(futures[fut])
+
+                    if time.monotonic() - last_checkpoint >= Config.MERGE_CHECKPOINT_INTERVAL:
+                        checkpoint.rows_done = sorted(rows_done)
+                        db.session.commit()
+                        last_checkpoint = time.monotonic()
+
+            elapsed = max(time.monotonic() - start, 1e-3)
+            span.set_attribute("rows_per_sec", merged_rows / elapsed)
+            span.set_attribute("read_bytes_per_sec", read / elapsed)
+            span.set_attribute("written_bytes_per_sec", written / elapsed)
+            span.set_attribute("commit", not failed)
+
+        self.logger.info(
+            "Merged %d rows of %s in %.1fs (%.1f rows/s, %.1f MB/s read, %.1f MB/s written)",
+            merged_rows, file_name, elapsed, merged_rows / elapsed, read / elapsed / 1e6, written / elapsed / 1e6,
+        )
+
+        if failed:
+            # Leave the checkpoint so the next merge retries the rows which failed
+            checkpoint.rows_done = sorted(rows_done)
+            db.session.commit()
+            return
+
+        # Every row exists, so move the bands over
+        bands = {
+            (band.file_name, band.offset): band
+            for band in FileBandMeta.query.filter(FileBandMeta.file_name.in_(source_names)).all()
+        }
+        for src, src_offset, _, merged_offset in plan:
+            band = bands.get((src, src_offset))
+            # The cleaner may have removed it in the meantime
+            if band is not None:
+                band.file_name = file_name
+                band.offset = merged_offset
+
+        db.session.delete(checkpoint)
+        notify_bands_changed(proj.id)
+        db.session.commit()
+
+        self.logger.info("Updated file band meta")
+
+    def plan_merges(self) -> List[merge_planner.ProjectionPlan]:
+        """
+        Decide which files to merge (see merge_planner)
+        """
+        # Files which are still part of an unfinished merge
+        merging = set(src for checkpoint in MergeCheckpoint.query.all() for src in checkpoint.source_file_names())
+
+        # Bands are loaded up front (instead of one query per file) since every file's are needed to plan
+        all_files = FileMeta.query.options(selectinload(FileMeta.bands)).filter(
+            FileMeta.file_name.in_(FileBandMeta.query.filter(FileBandMeta.valid_time > datetime.datetime.utcnow()).with_entities(FileBandMeta.file_name)),
+        ).all()
+
+        proj_files = collections.defaultdict(list)
+        for f in all_files:
+            if f.file_name not in merging:
+                proj_files[f.projection].append(f)
+
+        candidates = {}
+        for proj, files in proj_files.items():
+            access = load_access_fractions(proj.id)
+            n_locs = proj.n_x * proj.n_y
+
+            candidates[proj] = [
+                merge_planner.MergeCandidate(
+                    file=f,
+                    # The whole file is read, but only what's still used is written
+                    rewrite_bytes=n_locs * (f.loc_size + sum(size for _, _, size, _ in self._plan_merge([f]))),
+                    # Files which haven't been read by any query yet are almost always new, and most
+                    # queries are for upcoming data, so they're likely to be read by most queries.
+                    access=access.get(f.file_name, 1.0),
+                )
+                for f in files
+            ]
+
+        return merge_planner.plan_merges(candidates, Config.MERGE_REWRITE_BUDGET, Config.MERGE_MIN_READS_SAVED)
+
+    def merge(self):
+        """
+        Merge (small) files into larger files to reduce the number of reads each query needs to do.
+        """
+        # Finish up any merges which were interrupted first
+        for checkpoint in MergeCheckpoint.query.all():
+            self.logger.info("Resuming merge into %s", checkpoint.file_name)
+            self._run_merge(checkpoint.merged_file.projection, checkpoint)
+
+        plans = self.plan_merges()
+        self.logger.info("Merge plan:\n%s", merge_planner.describe_plan(plans))
+
+        for plan in plans:
+            for batch in plan.batches:
+                self._start_merge(plan.projection, batch.files)
+
+                self.logger.info("Storage stats: %s", self.stats())
+
+            # We know we won't need this projection again, so clear it
+            clear_proj_cache()
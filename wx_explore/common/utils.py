@@ -1,12 +1,18 @@
 from collections.abc import Iterable
 from itertools import islice
+from requests.adapters import HTTPAdapter
 from typing import Iterable as IterableT, Tuple, Any
+import asyncio
 import collections
+import contextvars
 import datetime
 import functools
 import logging
 import math
+import numpy
+import os
 import requests
+import threading
 import time
 
 
@@ -23,19 +29,67 @@ def datetime2unix(dt: datetime.datetime) -> int:
     return int(dt.timestamp())
 
 
+def datetime2numpy(dt: datetime.datetime) -> numpy.datetime64:
+    """
+    Convert the given datetime `dt` to a (naive, utc) numpy datetime64.
+    If `dt` has no tz associated with it, it is assumed to be utc.
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return numpy.datetime64(dt, 'us')
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+async def run_in_thread(func, *args):
+    """
+    Run the given blocking function on the running loop's default executor, in a copy of the current
+    context (so e.g. Flask's app context is kept). Same as asyncio.to_thread, which needs Python 3.9+.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(ctx.run, func, *args))
+
+
+def get_session() -> requests.Session:
+    """
+    Get a requests Session shared by the whole process (and all threads in it) so that
+    connections are kept alive and reused between requests.
+    """
+    global _session, _session_pid
+
+    # Connections can't be shared with forked processes
+    if _session_pid != os.getpid():
+        with _session_lock:
+            if _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+                _session_pid = os.getpid()
+
+    return _session
+
+
 def get_url(url, headers=None, retries=3):
     if headers is None:
         headers = {}
 
+    session = get_session()
+
     for i in range(retries):
         try:
-            r = requests.get(url, headers=headers, timeout=30)
+            r = session.get(url, headers=headers, timeout=30)
             if i == 0 and r.status_code == 404:
                 # NOMADS seems to have bad load balancing and will occasionally return 404
                 # for a file that has been previously fetched.
                 # Retry once
                 time.sleep(1)
-                r = requests.get(url, headers=headers)
+                r = session.get(url, headers=headers, timeout=30)
             break
         except KeyboardInterrupt:
             raise
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 from datetime import datetime, timedelta
-from sqlalchemy import func
+from sqlalchemy.orm import aliased
+import argparse
 import logging
 
 from wx_explore.common import storage
+from wx_explore.common.config import Config
+from wx_explore.common.db_utils import drop_band_partitions, ensure_band_partitions
+from wx_explore.common.storage.band_index import notify_bands_changed
 from wx_explore.common.logging import init_sentry
 from wx_explore.common.models import (
     FileBandMeta,
@@ -13,30 +17,44 @@ from wx_explore.web.core import db
 logger = logging.getLogger(__name__)
 
 
-def clean_old_datas():
-    # Delete all band metadata that is too old
+def clean_old_datas(scan_orphans: bool = False):
+    # Make sure upcoming data has somewhere to go
+    created = ensure_band_partitions(datetime.utcnow(), datetime.utcnow() + timedelta(days=Config.BAND_PARTITION_DAYS_AHEAD))
+    db.session.commit()
+    logger.info("Created band partitions %s", created)
+
+    # Delete all band metadata that is too old: whole days at once by dropping their partitions,
+    # then whatever is left (part of a day, or in the default partition)
     oldest_time = datetime.utcnow() - timedelta(days=1)
+    dropped = drop_band_partitions(oldest_time)
+    logger.info("Dropped band partitions %s", dropped)
     FileBandMeta.query.filter(FileBandMeta.valid_time < oldest_time).delete()
+    notify_bands_changed()
     db.session.commit()
 
     # For things >1day old and < now, only keep the most recent run per (sourcefield, valid_time)
-    most_recent = FileBandMeta.query.with_entities(func.max(FileBandMeta.run_time), FileBandMeta.source_field_id, FileBandMeta.valid_time).filter(
-        FileBandMeta.valid_time < datetime.utcnow() - timedelta(hours=1)
-    ).group_by(FileBandMeta.source_field_id, FileBandMeta.valid_time).all()
-
-    for (newest_run_time, sfid, valid_time) in most_recent:
-        FileBandMeta.query.filter(
-            FileBandMeta.source_field_id == sfid,
-            FileBandMeta.valid_time == valid_time,
-            FileBandMeta.run_time < newest_run_time,
-        ).delete()
-
+    # (done as a single DELETE of every band which has a newer run)
+    newer = aliased(FileBandMeta)
+    FileBandMeta.query.filter(
+        FileBandMeta.valid_time < datetime.utcnow() - timedelta(hours=1),
+        db.session.query(newer).filter(
+            newer.source_field_id == FileBandMeta.source_field_id,
+            newer.valid_time == FileBandMeta.valid_time,
+            newer.run_time > FileBandMeta.run_time,
+        ).exists(),
+    ).delete(synchronize_session=False)
+
+    notify_bands_changed()
     db.session.commit()
 
-    storage.get_provider().clean(oldest_time)
+    storage.get_provider().clean(oldest_time, scan_orphans=scan_orphans)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remove old data')
+    parser.add_argument('--scan-orphans', action='store_true', help='Also look through all of storage for untracked data (slow)')
+    args = parser.parse_args()
+
     init_sentry()
     logging.basicConfig(level=logging.INFO)
-    clean_old_datas()
+    clean_old_datas(scan_orphans=args.scan_orphans)
@@ -1,3 +1,5 @@
+from typing import Dict, Optional, Tuple
+
 import binascii
 import logging
 import numpy
@@ -15,13 +17,48 @@ def get_queue():
     return pq['ingest']
 
 
+# GRIB keys which (along with projparams) identify a message's grid, without having to look at every lat/lon
+GRID_KEYS = (
+    'Ni', 'Nj', 'Nx', 'Ny',
+    'latitudeOfFirstGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees',
+    'latitudeOfLastGridPointInDegrees', 'longitudeOfLastGridPointInDegrees',
+    'iDirectionIncrementInDegrees', 'jDirectionIncrementInDegrees',
+    'DxInMetres', 'DyInMetres',
+)
+
+# Grid fingerprint -> Projection.id of every grid this process has seen
+_projection_ids: Dict[Tuple, int] = {}
+
+
+def grid_fingerprint(msg) -> Optional[Tuple]:
+    """
+    Cheap identifier of the grid of the given message
+    :return: Fingerprint, or None if the message doesn't have enough grid keys to identify its grid
+    """
+    keys = tuple((key, msg[key]) for key in GRID_KEYS if msg.valid_key(key))
+    found = set(key for key, _ in keys)
+
+    has_shape = {'Ni', 'Nj'} <= found or {'Nx', 'Ny'} <= found
+    has_corner = {'latitudeOfFirstGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees'} <= found
+    if not (has_shape and has_corner):
+        return None
+
+    return (tuple(sorted(msg.projparams.items())),) + keys
+
+
 def get_or_create_projection(msg):
+    fingerprint = grid_fingerprint(msg)
+    if fingerprint is not None and fingerprint in _projection_ids:
+        projection = Projection.query.get(_projection_ids[fingerprint])
+        if projection is not None:
+            return projection
+
     lats, lons = msg.latlons()
 
     # GFS (and maybe others) have lons that range 0-360 instead of -180 to 180.
     # If found, transform them to match the standard range.
     if lons.max() > 180:
-        lons = numpy.vectorize(lambda n: n if 0 <= n < 180 else n-360)(lons)
+        lons = numpy.where((lons >= 0) & (lons < 180), lons, lons - 360)
 
     ll_hash = binascii.crc32(numpy.round([lats, lons], 8).tobytes())
 
@@ -35,8 +72,8 @@ def get_or_create_projection(msg):
 
         projection = Projection(
             params=msg.projparams,
-            n_x=msg.values.shape[1],
-            n_y=msg.values.shape[0],
+            n_x=lats.shape[1],
+            n_y=lats.shape[0],
             ll_hash=ll_hash,
             lats=lats.tolist(),
             lons=lons.tolist(),
@@ -44,6 +81,9 @@ def get_or_create_projection(msg):
         db.session.add(projection)
         db.session.commit()
 
+    if fingerprint is not None:
+        _projection_ids[fingerprint] = projection.id
+
     return projection
 
 
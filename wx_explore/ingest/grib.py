@@ -1,16 +1,22 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
 import collections
+import concurrent.futures
 import datetime
 import logging
 import numpy
 import pygrib
+import time
 
 from wx_explore.common import tracing, storage
+from wx_explore.common.config import Config
 from wx_explore.common.models import (
     Metric,
     SourceField,
 )
 from wx_explore.common.utils import get_url
 from wx_explore.ingest.common import get_or_create_projection, get_source_module
+from wx_explore.ingest.grib_decode import GribDecoder, decode_grib
 from wx_explore.web.core import db
 
 logger = logging.getLogger(__name__)
@@ -49,33 +55,192 @@ def get_grib_ranges(idxs, source_fields):
     return offsets
 
 
-def reduce_grib(grib_url, idx_url, source_fields, out_f):
+def coalesce_grib_ranges(offsets, max_gap):
+    """
+    Group ranges which are close enough together that it's cheaper to download the unneeded
+    bytes between them than to make another request.
+    :param offsets: List of (start, length), as returned by get_grib_ranges
+    :param max_gap: Max number of unneeded bytes to download between two ranges
+    :return: List of (start, length, [(start, length), ...]) of each range to download and
+             the wanted ranges within it
+    """
+    groups = []
+    for offset, length in sorted(offsets):
+        if groups and offset - (groups[-1][0] + groups[-1][1]) <= max_gap:
+            group_start, _, ranges = groups[-1]
+            groups[-1] = (group_start, max(groups[-1][1], offset + length - group_start), ranges)
+            ranges.append((offset, length))
+        else:
+            groups.append((offset, length, [(offset, length)]))
+
+    return groups
+
+
+def get_grib_range(grib_url, offset, length, retries=3):
+    """
+    Download `length` bytes of the GRIB at grib_url starting at `offset`
+    """
+    end = offset + length - 1
+
+    for i in range(retries):
+        grib_data = get_url(grib_url, headers={
+            "Range": f"bytes={offset}-{end}"
+        }).content
+
+        if len(grib_data) == length:
+            return grib_data
+
+        logger.warning("Got %d bytes for range %d-%d of %s (expected %d). Retrying...", len(grib_data), offset, end, grib_url, length)
+        time.sleep(3**i)
+
+    raise Exception(f"Unable to fetch bytes {offset}-{end} of {grib_url} after {retries} retries!")
+
+
+def stream_grib(grib_url, idx_url, source_fields) -> Iterator[bytes]:
     """
     Downloads the appropriate chunks (based on desired fields described by source_fields)
-    of the GRIB at grib_url (using idx_url to quickly seek around) and writes the chunks
-    to out_f.
+    of the GRIB at grib_url (using idx_url to quickly seek around), yielding each chunk (GRIB message)
+    in offset order as soon as it is available.
+
+    Nearby chunks are downloaded together, and all downloads are done concurrently.
+    If any chunk can't be downloaded an exception is raised, since the output would be incomplete.
 
     It is assumed that the caller has checked that the URLs exist before this function is called.
     """
     idxs = get_url(idx_url).text
     offsets = get_grib_ranges(idxs, source_fields)
+    groups = coalesce_grib_ranges(offsets, Config.GRIB_RANGE_MAX_GAP)
 
-    for offset, length in offsets:
-        start = offset
-        end = offset + length - 1
+    with tracing.start_span('download grib ranges') as span:
+        span.set_attribute('num_ranges', len(offsets))
+        span.set_attribute('num_requests', len(groups))
+
+        with concurrent.futures.ThreadPoolExecutor(Config.GRIB_DOWNLOAD_WORKERS) as executor:
+            # map() yields in submission order, so chunks are yielded in offset order
+            for (group_start, _, ranges), grib_data in zip(groups, executor.map(
+                    lambda group: get_grib_range(grib_url, group[0], group[1]),
+                    groups,
+            )):
+                for offset, length in ranges:
+                    rel = offset - group_start
+                    yield grib_data[rel:rel+length]
 
-        try:
-            grib_data = get_url(grib_url, headers={
-                "Range": f"bytes={start}-{end}"
-            }).content
-        except Exception as e:
-            logger.exception("Unable to fetch grib data. Continuing anyways...")
-            continue
 
+def reduce_grib(grib_url, idx_url, source_fields, out_f):
+    """
+    Downloads the appropriate chunks of the GRIB at grib_url (see stream_grib) and writes the chunks
+    to out_f.
+    :return: Number of chunks (GRIB messages) written to out_f
+    """
+    n = 0
+    for grib_data in stream_grib(grib_url, idx_url, source_fields):
         out_f.write(grib_data)
+        n += 1
 
     out_f.flush()
 
+    return n
+
+
+def stream_grib_messages(grib_url, idx_url, source_fields) -> Iterator[pygrib.gribmessage]:
+    """
+    Like stream_grib, but yields decoded messages. Later chunks keep downloading while
+    the messages already yielded are being processed.
+    """
+    for grib_data in stream_grib(grib_url, idx_url, source_fields):
+        yield from decode_grib(grib_data)
+
+
+# Message keys which are read once per message and indexed, since (nearly) all selectors use them
+INDEX_KEYS = ('shortName', 'name', 'typeOfLevel', 'level', 'stepType')
+
+_MISSING = object()
+
+
+def grib_message_keys(msg) -> Dict[str, Any]:
+    """
+    Read all INDEX_KEYS of the given message
+    """
+    return {key: msg[key] for key in INDEX_KEYS if msg.valid_key(key)}
+
+
+def grib_message_matches(msg, selectors: Dict[str, Any], keys: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Whether the given message matches all selectors, with the same semantics as pygrib's select():
+    a selector can be a value, a list/tuple of allowed values, or a function returning whether the value is allowed.
+    :param keys: Already read INDEX_KEYS of msg (see grib_message_keys), to avoid reading them from the message again
+    """
+    for key, want in selectors.items():
+        if keys is not None and key in INDEX_KEYS:
+            val = keys.get(key, _MISSING)
+        else:
+            val = msg[key] if msg.valid_key(key) else _MISSING
+
+        if val is _MISSING:
+            return False
+
+        if callable(want):
+            if not want(val):
+                return False
+        elif isinstance(want, (list, tuple, set)):
+            if val not in want:
+                return False
+        elif val != want:
+            return False
+
+    return True
+
+
+class GribIndex(object):
+    """
+    In-memory collection of decoded GRIB messages, indexed by their INDEX_KEYS so that they can be
+    selected from (like a pygrib.open) without scanning and reading keys from every message.
+    """
+    msgs: List[pygrib.gribmessage]
+
+    def __init__(self, msgs: Optional[Iterable[pygrib.gribmessage]] = None):
+        self.msgs = []
+        self._keys: List[Dict[str, Any]] = []
+        # (key, value) -> indexes of all messages with that value
+        self._postings: Dict[Tuple[str, Any], List[int]] = collections.defaultdict(list)
+
+        for msg in (msgs or []):
+            self.add(msg)
+
+    def add(self, msg: pygrib.gribmessage, keys: Optional[Dict[str, Any]] = None):
+        if keys is None:
+            keys = grib_message_keys(msg)
+
+        i = len(self.msgs)
+        self.msgs.append(msg)
+        self._keys.append(keys)
+
+        for key, val in keys.items():
+            self._postings[(key, val)].append(i)
+
+    def __iter__(self):
+        return iter(self.msgs)
+
+    def __len__(self) -> int:
+        return len(self.msgs)
+
+    def select(self, **kwargs) -> List[pygrib.gribmessage]:
+        # Narrow down to the messages with the rarest exactly matching indexed value,
+        # then check all selectors against just those.
+        candidates = range(len(self.msgs))
+        for key, want in kwargs.items():
+            if key in INDEX_KEYS and not callable(want) and not isinstance(want, (list, tuple, set)):
+                posting = self._postings.get((key, want), [])
+                if len(posting) < len(candidates):
+                    candidates = posting
+
+        msgs = [self.msgs[i] for i in candidates if grib_message_matches(self.msgs[i], kwargs, self._keys[i])]
+
+        if not msgs:
+            raise ValueError('no matches found')
+
+        return msgs
+
 
 def get_end_valid_time(msg):
     """
@@ -110,40 +275,149 @@ def ingest_grib_file(file_path, source):
     """
     logger.info("Processing GRIB file '%s'", file_path)
 
-    grib = pygrib.open(file_path)
+    with GribDecoder(Config.GRIB_DECODE_WORKERS) as decoder:
+        ingest_grib_messages(pygrib.open(file_path), source, decoder=decoder)
+
+
+class FieldBuffer(object):
+    """
+    Buffers fields ingested from any number of GRIBs (e.g. several forecast hours of a run) so that all
+    of each projection's fields can be written as a single file group.
+    """
+    max_bytes: int
+    nbytes: int
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # Map of projection to map of {(field_id, valid_time, run_time) -> [msg, ...]}
+        self.data_by_projection = collections.defaultdict(lambda: collections.defaultdict(list))
+
+    def add(self, data_by_projection):
+        for proj, fields in data_by_projection.items():
+            for k, v in fields.items():
+                self.data_by_projection[proj][k].extend(v)
+                self.nbytes += sum(vals.nbytes for vals in v)
+
+    def full(self) -> bool:
+        return self.nbytes >= self.max_bytes
+
+    def flush(self):
+        """
+        Save everything buffered. Nothing is buffered afterwards, even if saving fails.
+        """
+        try:
+            with tracing.start_span('save denormalized') as span:
+                span.set_attribute('bytes', self.nbytes)
+                logger.info("Saving denormalized location/time data for all messages")
+                for proj, fields in self.data_by_projection.items():
+                    storage.get_provider().put_fields(proj, fields)
+
+            logger.info("Done saving denormalized data")
+        finally:
+            self.data_by_projection.clear()
+            self.nbytes = 0
+
+
+def ingest_grib_messages(
+        msgs: Iterable[pygrib.gribmessage],
+        source,
+        buffer: Optional[FieldBuffer] = None,
+        decoder: Optional[GribDecoder] = None,
+):
+    """
+    Ingests the given GRIB messages into the backend. Each message is processed as soon as it is
+    yielded, so msgs can be a stream of messages which are still being downloaded (see stream_grib_messages).
+    :param msgs: GRIB messages
+    :param source: Source object which denotes which source this data is from
+    :param buffer: If given, all fields are added to this buffer (only once every message has been processed)
+                   instead of being saved immediately
+    :param decoder: Decoder to unpack message values with. By default they're unpacked in this process.
+    :return: None
+    """
+    if decoder is None:
+        with GribDecoder(1) as decoder:
+            return ingest_grib_messages(msgs, source, buffer, decoder)
+
+    source_module = get_source_module(source.short_name)
+
+    fields = SourceField.query.filter(SourceField.source_id == source.id, SourceField.metric.has(Metric.intermediate == False)).all()
+    matched_field_ids = set()
+
+    # Projections of every grid seen in this GRIB (usually just one), keyed by projparams, so that
+    # each is only looked up once. Field projection changes are committed once, after all messages.
+    projections = {}
+
+    # Messages needed to derive fields from once everything has been processed
+    grib = GribIndex()
 
     # Keeps all data points that we'll be inserting at the end.
     # Map of projection to map of {(field_id, valid_time, run_time) -> [msg, ...]}
     data_by_projection = collections.defaultdict(lambda: collections.defaultdict(list))
+    # Values of each message may still be being decoded while later messages are read,
+    # so they're only added to data_by_projection once every message has been read.
+    # List of (projection, (field_id, valid_time, run_time), future of values)
+    decoded = []
 
-    for field in SourceField.query.filter(SourceField.source_id == source.id, SourceField.metric.has(Metric.intermediate == False)).all():
-        try:
-            msgs = grib.select(**field.selectors)
-        except ValueError:
-            logger.warning("Could not find message(s) in grib matching selectors %s", field.selectors)
+    n_msgs = 0
+    n_skipped = 0
+
+    for msg in msgs:
+        n_msgs += 1
+        keys = grib_message_keys(msg)
+
+        msg_fields = [field for field in fields if grib_message_matches(msg, field.selectors, keys)]
+
+        used_for_derived = any(grib_message_matches(msg, selectors, keys) for selectors in source_module.DERIVED_SELECTORS)
+        if used_for_derived:
+            grib.add(msg, keys)
+
+        if not msg_fields:
+            # Nothing (else) uses this message, so don't bother decoding its values
+            decoder.skip(msg)
+            if not used_for_derived:
+                n_skipped += 1
             continue
 
-        for msg in msgs:
-            with tracing.start_span('parse message') as span:
-                span.set_attribute('message', str(msg))
+        with tracing.start_span('parse message') as span:
+            span.set_attribute('message', str(msg))
+
+            # Only decode values once, no matter how many fields use them
+            values = decoder.submit(msg)
+            valid_date = get_end_valid_time(msg)
+
+            for field in msg_fields:
+                matched_field_ids.add(field.id)
 
                 if field.projection is None or field.projection.params != msg.projparams:
-                    projection = get_or_create_projection(msg)
-                    field.projection_id = projection.id
-                    db.session.commit()
+                    params_key = tuple(sorted(msg.projparams.items()))
+                    if params_key not in projections:
+                        projections[params_key] = get_or_create_projection(msg)
+                    field.projection = projections[params_key]
+
+                decoded.append((field.projection, (field.id, valid_date, msg.analDate), values))
+
+    logger.info("Processed %d messages (%d unused)", n_msgs, n_skipped)
 
-                valid_date = get_end_valid_time(msg)
-                data_by_projection[field.projection][(field.id, valid_date, msg.analDate)].append(msg.values)
+    with tracing.start_span('decode messages'):
+        for proj, key, values in decoded:
+            data_by_projection[proj][key].append(values.result())
+
+    db.session.commit()
+
+    for field in fields:
+        if field.id not in matched_field_ids:
+            logger.warning("Could not find message(s) in grib matching selectors %s", field.selectors)
 
     with tracing.start_span('generate derived'):
         logger.info("Generating derived fields")
-        for proj, fields in get_source_module(source.short_name).generate_derived(grib).items():
+        for proj, fields in source_module.generate_derived(grib).items():
             for k, v in fields.items():
                 data_by_projection[proj][k].extend(v)
 
-    with tracing.start_span('save denormalized'):
-        logger.info("Saving denormalized location/time data for all messages")
-        for proj, fields in data_by_projection.items():
-            storage.get_provider().put_fields(proj, fields)
-
-    logger.info("Done saving denormalized data")
+    if buffer is None:
+        buffer = FieldBuffer()
+        buffer.add(data_by_projection)
+        buffer.flush()
+    else:
+        buffer.add(data_by_projection)
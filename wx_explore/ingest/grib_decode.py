@@ -0,0 +1,161 @@
+"""
+Decoding of GRIB message values, optionally on a pool of worker processes.
+
+This only depends on pygrib and numpy (not on the DB or the rest of wx_explore) so that
+spawned decode workers start quickly.
+"""
+from multiprocessing import resource_tracker, shared_memory
+from typing import List, Tuple
+
+import concurrent.futures
+import multiprocessing
+import numpy
+import os
+import pygrib
+
+
+def decode_grib(grib_data: bytes) -> List[pygrib.gribmessage]:
+    """
+    Decode all messages in the given raw GRIB data without writing it to disk.
+
+    pygrib.fromstring only decodes the first field of a message, and some sources (e.g. NAM) have
+    messages with multiple fields, so this is read through an in-memory file instead.
+    """
+    fd = os.memfd_create('grib')
+    try:
+        with os.fdopen(os.dup(fd), 'wb') as f:
+            f.write(grib_data)
+
+        grib = pygrib.open(f"/proc/self/fd/{fd}")
+        try:
+            return grib.read()
+        finally:
+            grib.close()
+    finally:
+        os.close(fd)
+
+
+def message_values(msg: pygrib.gribmessage) -> numpy.ndarray:
+    """
+    Unpack all values of the given message as float32
+    """
+    # Masked (missing) points keep the message's missing value, like the unmasked data of msg.values
+    return numpy.ma.getdata(msg.values).astype(numpy.float32)
+
+
+def _decode_values(grib_data: bytes, field: int) -> Tuple[str, Tuple[int, ...]]:
+    """
+    Decode worker: unpack the values of the given field of the given raw GRIB message into a new
+    shared memory block, which the caller takes ownership of (and must unlink).
+    :return: Name of the shared memory block, and the shape of the values in it
+    """
+    fields = decode_grib(grib_data)
+    # Consecutive messages with identical data are counted as fields of the same message (see
+    # GribDecoder._track), so wrap around to get the right field of each copy
+    values = message_values(fields[field % len(fields)])
+
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    numpy.ndarray(values.shape, dtype=numpy.float32, buffer=shm.buf)[...] = values
+    # Otherwise this process's resource tracker would remove the block out from under the caller
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+
+    return shm.name, values.shape
+
+
+def _take_values(name: str, shape: Tuple[int, ...]) -> numpy.ndarray:
+    """
+    Copy values out of a shared memory block made by _decode_values, and remove it
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return numpy.ndarray(shape, dtype=numpy.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class GribDecoder(object):
+    """
+    Unpacks the values of GRIB messages on a pool of worker processes, since unpacking is CPU bound
+    and mostly holds the GIL. Values are handed back through shared memory instead of being pickled.
+
+    Every message read must be either submitted or skipped, in the order they were read, so that
+    fields of multi-field messages can be told apart.
+    """
+    workers: int
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+        # Raw data of the last message read, and which of its fields that was
+        self._last_raw = None
+        self._field = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _track(self, msg: pygrib.gribmessage) -> Tuple[bytes, int]:
+        """
+        :return: Raw data of the given message, and which of its fields the message is
+        """
+        # Every field of a multi-field message has the whole message as its raw data. pygrib numbers
+        # each field as its own message (msg.messagenumber), so that can't tell them apart either.
+        # Repeated identical messages look like extra fields, which _decode_values wraps around.
+        raw = msg.tostring()
+        if raw == self._last_raw:
+            self._field += 1
+        else:
+            self._last_raw = raw
+            self._field = 0
+
+        return raw, self._field
+
+    def skip(self, msg: pygrib.gribmessage):
+        """
+        Note that the given message was read, but its values aren't needed
+        """
+        if self.workers > 1:
+            self._track(msg)
+
+    def submit(self, msg: pygrib.gribmessage) -> concurrent.futures.Future:
+        """
+        Start unpacking the values of the given message
+        :return: Future of the (float32) values
+        """
+        if self.workers <= 1:
+            fut = concurrent.futures.Future()
+            try:
+                fut.set_result(message_values(msg))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
+
+        if self._executor is None:
+            # Spawned instead of forked so workers don't inherit DB connections, threads, etc.
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+
+        raw, field = self._track(msg)
+
+        result = concurrent.futures.Future()
+
+        def done(fut):
+            try:
+                result.set_result(_take_values(*fut.result()))
+            except Exception as e:
+                result.set_exception(e)
+
+        self._executor.submit(_decode_values, raw, field).add_done_callback(done)
+
+        return result
@@ -1,14 +1,23 @@
+import argparse
 import logging
 import numpy
 
 from wx_explore.common import tracing, storage
 from wx_explore.common.logging import init_sentry
+from wx_explore.common.storage.merge_planner import describe_plan
 from wx_explore.common.tracing import init_tracing
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge stored files to reduce the number of reads per query')
+    parser.add_argument('--dry-run', action='store_true', help='Print what would be merged and the expected savings, without merging')
+    args = parser.parse_args()
+
     init_sentry()
     logging.basicConfig(level=logging.INFO)
     init_tracing('merge')
     with tracing.start_span('merge'):
-        storage.get_provider().merge()
+        if args.dry_run:
+            print(describe_plan(storage.get_provider().plan_merges()))
+        else:
+            storage.get_provider().merge()
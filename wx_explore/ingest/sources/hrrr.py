@@ -24,6 +24,10 @@ logger = logging.getLogger(__name__)
 class HRRR(IngestSource):
     SOURCE_NAME = "hrrr"
 
+    U_SELECTORS = {'name': '10 metre U wind component', 'stepType': 'avg'}
+    V_SELECTORS = {'name': '10 metre V wind component', 'stepType': 'avg'}
+    DERIVED_SELECTORS = [U_SELECTORS, V_SELECTORS]
+
     @staticmethod
     def generate_derived(grib):
         logger.info("Deriving wind")
@@ -42,8 +46,8 @@ class HRRR(IngestSource):
 
         # XXX: switch to using group_by_time from analysis
         uv_pairs = zip(
-            sorted(grib.select(name='10 metre U wind component', stepType='avg'), key=lambda m: (m.validDate, m.analDate)),
-            sorted(grib.select(name='10 metre V wind component', stepType='avg'), key=lambda m: (m.validDate, m.analDate)),
+            sorted(grib.select(**HRRR.U_SELECTORS), key=lambda m: (m.validDate, m.analDate)),
+            sorted(grib.select(**HRRR.V_SELECTORS), key=lambda m: (m.validDate, m.analDate)),
         )
 
         logging.debug("Got uv_pairs")
@@ -1,12 +1,13 @@
-from typing import Optional
+from typing import Any, Dict, List, Optional
 import datetime
-import pygrib
 
 from wx_explore.common.models import Source
 
 
 class IngestSource(object):
     SOURCE_NAME = None
+    # Selectors of all messages generate_derived uses, so other unused messages can be skipped
+    DERIVED_SELECTORS: List[Dict[str, Any]] = []
 
     @classmethod
     def get_db_source(cls):
@@ -22,5 +23,10 @@ class IngestSource(object):
         raise NotImplementedError
 
     @staticmethod
-    def generate_derived(grib: pygrib.open):
+    def generate_derived(grib):
+        """
+        Generate any fields derived from other messages in the given GRIB
+        :param grib: Messages of the GRIB being ingested (anything with pygrib-style select(), e.g. GribIndex)
+        :return: Map of projection to map of {(field_id, valid_time, run_time) -> [values, ...]}
+        """
         return {}
@@ -1,70 +1,427 @@
 #!/usr/bin/env python3
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
 
+import argparse
+import collections
+import concurrent.futures
 import logging
-import tempfile
+import multiprocessing
+import os
+import signal
+import threading
+import time
 
 from wx_explore.common import tracing
+from wx_explore.common.config import Config
 from wx_explore.common.logging import init_sentry
 from wx_explore.common.models import Source
 from wx_explore.common.tracing import init_tracing
 from wx_explore.common.utils import url_exists
 from wx_explore.ingest.common import get_queue
-from wx_explore.ingest.grib import reduce_grib, ingest_grib_file
+from wx_explore.ingest.grib import FieldBuffer, stream_grib_messages, ingest_grib_messages
+from wx_explore.ingest.grib_decode import GribDecoder
 from wx_explore.web.core import db
 
 logger = logging.getLogger(__name__)
 
+# Result of ingesting a single item: (item, delay to requeue it with (None if done), run-to-available latency in seconds (None if not ingested))
+ItemResult = Tuple[Dict[str, Any], Optional[str], Optional[float]]
 
-def ingest_from_queue():
-    q = get_queue()
-    for ingest_req in q:
-        # Queue is empty for now
-        if ingest_req is None:
-            logger.info("Empty queue")
-            break
 
-        ingest_req = ingest_req.data
+def ingest_items(ingest_reqs: List[Dict[str, Any]], decode_workers: int = 1) -> List[ItemResult]:
+    """
+    Ingest a group of items which are all from the same source and run, sharing DB lookups and commits between them.
+    Fields from all items are buffered (up to INGEST_BUFFER_MAX_BYTES) and written together, so that each
+    projection gets as few file groups as possible.
+    Runs in a worker process.
+    :param decode_workers: Number of processes to unpack GRIB message values with (see GribDecoder)
+    """
+    results = []
 
-        # Expire out anything whose valid time is very old (probably a bad request/URL)
-        if datetime.utcfromtimestamp(ingest_req['valid_time']) < datetime.utcnow() - timedelta(hours=12):
-            logger.info("Expiring old request %s", ingest_req)
-            continue
+    source = Source.query.filter_by(short_name=ingest_reqs[0]['source']).first()
+
+    buffer = FieldBuffer(Config.INGEST_BUFFER_MAX_BYTES)
+    # Items whose fields are in buffer
+    buffered_reqs = []
+
+    def flush():
+        try:
+            buffer.flush()
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            logger.exception("Exception while saving %d items. Will retry", len(buffered_reqs))
+            db.session.rollback()
+            results.extend((ingest_req, '4m', None) for ingest_req in buffered_reqs)
+        else:
+            for ingest_req in buffered_reqs:
+                latency = (datetime.utcnow() - datetime.utcfromtimestamp(ingest_req['run_time'])).total_seconds()
+                results.append((ingest_req, None, latency))
+
+        buffered_reqs.clear()
+
+    with tracing.start_span('ingest group') as span, GribDecoder(decode_workers) as decoder:
+        span.set_attribute('source', source.short_name)
+        span.set_attribute('num_items', len(ingest_reqs))
+
+        for ingest_req in ingest_reqs:
+            # Expire out anything whose valid time is very old (probably a bad request/URL)
+            if datetime.utcfromtimestamp(ingest_req['valid_time']) < datetime.utcnow() - timedelta(hours=12):
+                logger.info("Expiring old request %s", ingest_req)
+                results.append((ingest_req, None, None))
+                continue
+
+            # If this URL doesn't exist, try again in a few minutes
+            if not (url_exists(ingest_req['url']) and url_exists(ingest_req['idx_url'])):
+                logger.info("Rescheduling request %s", ingest_req)
+                results.append((ingest_req, '5m', None))
+                continue
+
+            with tracing.start_span('ingest item') as span:
+                for k, v in ingest_req.items():
+                    span.set_attribute(k, v)
+
+                try:
+                    # Messages are decoded and ingested as they're downloaded
+                    with tracing.start_span('download and ingest'):
+                        logging.info(f"Downloading and ingesting {ingest_req['url']} from {ingest_req['run_time']} {source.short_name}")
+                        msgs = stream_grib_messages(ingest_req['url'], ingest_req['idx_url'], source.fields)
+                        ingest_grib_messages(msgs, source, buffer, decoder)
+                except KeyboardInterrupt:
+                    raise
+                except Exception:
+                    logger.exception("Exception while ingesting %s. Will retry", ingest_req)
+                    db.session.rollback()
+                    results.append((ingest_req, '4m', None))
+                    continue
+
+            buffered_reqs.append(ingest_req)
+
+            if buffer.full():
+                flush()
+
+        flush()
+
+        source.last_updated = datetime.utcnow()
+        db.session.commit()
+
+    return results
+
+
+def init_worker_process():
+    init_sentry()
+    logging.basicConfig(level=logging.INFO)
+    init_tracing('queue_worker')
+
+
+class PendingItems(object):
+    """
+    Items pulled from the queue which are waiting to be ingested, grouped by source and run.
+
+    Items are held until their group is full or the oldest item in it has waited max_delay seconds,
+    so that as many items as possible are ingested (and their fields written) together.
+    """
+    max_group_size: int
+    max_delay: float
+
+    def __init__(self, max_group_size: int, max_delay: float):
+        self.max_group_size = max_group_size
+        self.max_delay = max_delay
+        # (source, run_time) -> (time first item was added, [item, ...])
+        self._groups: Dict[Tuple[str, int], Tuple[float, List[Dict[str, Any]]]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(items) for _, items in self._groups.values())
+
+    def add(self, ingest_req: Dict[str, Any]):
+        key = (ingest_req['source'], ingest_req['run_time'])
+        if key not in self._groups:
+            self._groups[key] = (time.monotonic(), [])
+        self._groups[key][1].append(ingest_req)
+
+    def pop_ready(self, limit: int, flush_all: bool = False) -> List[List[Dict[str, Any]]]:
+        """
+        Remove and return up to `limit` groups which are ready to be ingested
+        :param flush_all: Consider all groups ready, no matter how long they've waited
+        """
+        ready = []
+
+        for key, (added, items) in list(self._groups.items()):
+            while len(ready) < limit and (
+                    len(items) >= self.max_group_size
+                    or (items and (flush_all or time.monotonic() - added >= self.max_delay))
+            ):
+                ready.append(items[:self.max_group_size])
+                del items[:self.max_group_size]
+
+            if not items:
+                del self._groups[key]
 
-        # If this URL doesn't exist, try again in a few minutes
-        if not (url_exists(ingest_req['url']) and url_exists(ingest_req['idx_url'])):
-            logger.info("Rescheduling request %s", ingest_req)
-            q.put(ingest_req, '5m')
+        return ready
+
+    def pop_all(self) -> List[Dict[str, Any]]:
+        items = [ingest_req for _, items in self._groups.values() for ingest_req in items]
+        self._groups.clear()
+        return items
+
+
+# (limit, usage, stats, stat name of reclaimable page cache) files of cgroup v2 and v1
+CGROUP_MEMORY_FILES = (
+    ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory.stat', 'inactive_file'),
+    ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes', '/sys/fs/cgroup/memory/memory.stat', 'total_inactive_file'),
+)
+
+
+def _read_stat(path: str, name: str) -> int:
+    try:
+        with open(path) as f:
+            for line in f:
+                key, val = line.split()
+                if key == name:
+                    return int(val)
+    except (OSError, ValueError):
+        pass
+
+    return 0
+
+
+def cgroup_available_memory() -> Optional[int]:
+    """
+    Bytes of memory left before hitting this process's cgroup (i.e. container) memory limit, or None if there's no limit
+    """
+    for limit_path, usage_path, stat_path, inactive_name in CGROUP_MEMORY_FILES:
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read())
+        except (OSError, ValueError):
             continue
 
-        with tracing.start_span('ingest item') as span:
-            for k, v in ingest_req.items():
-                span.set_attribute(k, v)
+        # cgroup v1 has no way to say "no limit" other than a huge number
+        if limit == 'max' or int(limit) >= 2**60:
+            return None
+
+        # Like the kubelet, count page cache which can be dropped as available
+        return int(limit) - (usage - _read_stat(stat_path, inactive_name))
 
-            try:
-                source = Source.query.filter_by(short_name=ingest_req['source']).first()
+    return None
 
-                with tempfile.NamedTemporaryFile() as reduced:
-                    with tracing.start_span('download'):
-                        logging.info(f"Downloading and reducing {ingest_req['url']} from {ingest_req['run_time']} {source.short_name}")
-                        reduce_grib(ingest_req['url'], ingest_req['idx_url'], source.fields, reduced)
-                    with tracing.start_span('ingest'):
-                        logging.info("Ingesting all")
-                        ingest_grib_file(reduced.name, source)
 
-                source.last_updated = datetime.utcnow()
+def available_memory() -> Optional[int]:
+    """
+    Bytes of memory available for new allocations without swapping or hitting a container memory limit, or None if unknown
+    """
+    available = []
 
-                db.session.commit()
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                logger.exception("Exception while ingesting %s. Will retry", ingest_req)
-                q.put(ingest_req, '4m')
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+
+    cgroup = cgroup_available_memory()
+    if cgroup is not None:
+        available.append(cgroup)
+
+    return min(available) if available else None
+
+
+class IngestStats(object):
+    """
+    Tracks throughput (items/min) and run-to-available latency (time from model run to data being queryable)
+    """
+    interval: float
+
+    def __init__(self, interval: float = 60):
+        self.interval = interval
+        self._last_report = time.monotonic()
+        self._items = 0
+        self._retries = 0
+        # source -> latencies of items ingested since the last report
+        self._latencies = collections.defaultdict(list)
+
+    def record(self, results: List[ItemResult]):
+        for ingest_req, requeue_delay, latency in results:
+            if requeue_delay is not None:
+                self._retries += 1
+            elif latency is not None:
+                self._items += 1
+                self._latencies[ingest_req['source']].append(latency)
+
+    def maybe_report(self):
+        elapsed = time.monotonic() - self._last_report
+        if elapsed < self.interval:
+            return
+
+        with tracing.start_span('ingest stats') as span:
+            items_per_min = self._items / (elapsed / 60)
+            span.set_attribute('items_per_min', items_per_min)
+            logger.info("Ingested %d items (%.1f items/min), %d rescheduled", self._items, items_per_min, self._retries)
+
+            for source, latencies in self._latencies.items():
+                span.set_attribute(f'{source}_latency_mean', sum(latencies) / len(latencies))
+                span.set_attribute(f'{source}_latency_max', max(latencies))
+                logger.info("%s run-to-available latency: mean %.0fs, max %.0fs", source, sum(latencies) / len(latencies), max(latencies))
+
+        self._last_report = time.monotonic()
+        self._items = 0
+        self._retries = 0
+        self._latencies.clear()
+
+
+def ingest_from_queue(processes: int = 1, exit_when_empty: bool = True):
+    """
+    Ingest items from the queue using a pool of worker processes.
+
+    Items are pulled only while there's a free worker process and enough free memory,
+    and are grouped by source/run so each worker can share work between them.
+    :param processes: Number of worker processes
+    :param exit_when_empty: Return once the queue is empty and all items have been processed, instead of running forever
+    """
+    q = get_queue()
+    stats = IngestStats()
+
+    # Cores not used by ingest processes themselves are used to unpack GRIB messages
+    decode_workers = Config.INGEST_DECODE_WORKERS or max(1, (os.cpu_count() or 1) // processes)
+    logger.info("Ingesting with %d processes, each unpacking GRIB messages with %d processes", processes, decode_workers)
+
+    def make_executor():
+        # Workers are spawned instead of forked so they don't share the parent's DB connections
+        return concurrent.futures.ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker_process,
+        )
+
+    executor = make_executor()
+    pending = PendingItems(Config.INGEST_GROUP_SIZE, Config.INGEST_BUFFER_MAX_DELAY)
+    # future -> group of items
+    in_flight = {}
+
+    # SIGTERM (e.g. from k8s stopping the pod) stops pulling items and reschedules everything pulled
+    # but not ingested, instead of killing the process and losing them
+    stop = threading.Event()
+
+    def request_stop(signum, _frame):
+        logger.info("Got signal %d. Stopping", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+
+    def handle_done(fut) -> bool:
+        """
+        Handle the results of a finished group
+        :return: Whether the worker pool is still usable
+        """
+        nonlocal executor
+
+        group = in_flight.pop(fut)
+
+        try:
+            results = fut.result()
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM killed), so all in flight work is lost
+            logger.error("Worker process died. Rescheduling all in progress items")
+            for lost_group in [group] + list(in_flight.values()):
+                for ingest_req in lost_group:
+                    q.put(ingest_req, '4m')
+            in_flight.clear()
+            # The broken pool's management thread and queues are only cleaned up by shutdown()
+            executor.shutdown(wait=False)
+            executor = make_executor()
+            return False
+        except Exception:
+            logger.exception("Exception while ingesting %s. Will retry", group)
+            results = [(ingest_req, '4m', None) for ingest_req in group]
+
+        for ingest_req, requeue_delay, _ in results:
+            if requeue_delay is not None:
+                q.put(ingest_req, requeue_delay)
+
+        stats.record(results)
+        return True
+
+    try:
+        while not stop.is_set():
+            free_workers = processes - len(in_flight)
+            queue_empty = False
+            mem = available_memory()
+
+            if free_workers > 0 and mem is not None and mem < Config.INGEST_MIN_AVAILABLE_MEMORY:
+                logger.info("Only %d bytes of memory available, waiting for items in progress to finish", mem)
+            elif free_workers > 0:
+                while len(pending) < free_workers * Config.INGEST_GROUP_SIZE:
+                    ingest_req = q.get(block=False)
+                    if ingest_req is None:
+                        queue_empty = True
+                        break
+                    pending.add(ingest_req.data)
+
+                # Once the queue has been drained there's no point in waiting for more items
+                for group in pending.pop_ready(free_workers, flush_all=queue_empty and exit_when_empty):
+                    in_flight[executor.submit(ingest_items, group, decode_workers)] = group
+
+            if not in_flight:
+                if exit_when_empty and queue_empty and not len(pending):
+                    logger.info("Empty queue")
+                    break
+
+                stop.wait(Config.INGEST_POLL_INTERVAL)
+                continue
+
+            # Wait in short slices so a stop request is noticed (and pending items are rescheduled) promptly
+            done = set()
+            deadline = time.monotonic() + Config.INGEST_POLL_INTERVAL
+            while not done and not stop.is_set() and time.monotonic() < deadline:
+                done, _ = concurrent.futures.wait(in_flight, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for fut in done:
+                if not handle_done(fut):
+                    break
+
+            stats.maybe_report()
+    finally:
+        # Don't lose anything that was pulled but never started
+        unstarted = pending.pop_all()
+        if unstarted:
+            logger.info("Rescheduling %d pending items", len(unstarted))
+        for ingest_req in unstarted:
+            q.put(ingest_req)
+
+        # Give items in progress a chance to finish, then reschedule whatever didn't. Those may end
+        # up ingested twice if their worker finishes anyways, but that's better than never.
+        if in_flight:
+            logger.info("Waiting up to %ds for %d groups in progress", Config.INGEST_SHUTDOWN_GRACE, len(in_flight))
+            done, _ = concurrent.futures.wait(in_flight, timeout=Config.INGEST_SHUTDOWN_GRACE)
+            for fut in done:
+                if fut in in_flight:
+                    handle_done(fut)
+
+            for fut, group in in_flight.items():
+                # Don't start anything that hasn't been yet (shutdown()'s cancel_futures needs python 3.9)
+                fut.cancel()
+                logger.info("Rescheduling %d unfinished items", len(group))
+                for ingest_req in group:
+                    q.put(ingest_req)
+            in_flight.clear()
+
+        executor.shutdown(wait=False)
 
 
 if __name__ == "__main__":
     init_sentry()
     logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Ingest queued items')
+    parser.add_argument('--processes', type=int, default=Config.INGEST_PROCESSES, help='Number of worker processes')
+    parser.add_argument('--once', action='store_true', help='Exit once the queue is empty instead of running forever')
+    args = parser.parse_args()
+
     init_tracing('queue_worker')
     with tracing.start_span('queue worker'):
-        ingest_from_queue()
+        ingest_from_queue(args.processes, exit_when_empty=args.once)
@@ -3,6 +3,7 @@ from flask import Blueprint, abort, jsonify, request
 from sqlalchemy import or_
 
 import collections
+import numpy
 import pytz
 import sqlalchemy
 
@@ -14,20 +15,24 @@ from wx_explore.common import (
     metrics,
     tracing,
 )
+from wx_explore.common.db_utils import run_db_async
 from wx_explore.common.models import (
     Source,
     SourceField,
     Location,
     Metric,
     Timezone,
+    DataPointBatch,
 )
-from wx_explore.common.storage import load_data_points
-from wx_explore.common.utils import datetime2unix
+from wx_explore.common.storage import load_data_points_async, load_data_points_many_async
 from wx_explore.web.app import app
 
 
 api = Blueprint('api', __name__, url_prefix='/api')
 
+# Max number of locations that can be requested in one /wx/batch call
+MAX_BATCH_LOCATIONS = 1000
+
 
 @api.route('/sources')
 def get_sources():
@@ -138,28 +143,12 @@ def get_tz_for_coords():
     })
 
 
-@api.route('/wx')
-def wx_for_location():
+def get_wx_time_range(start, end):
     """
-    Gets the weather for a specific location, optionally limiting by metric and time.
-    at that time.
+    Convert the given (optional) unix start and end times of a wx request into datetimes,
+    applying defaults and limits.
     """
-    lat = float(request.args['lat'])
-    lon = float(request.args['lon'])
-
-    if lat > 90 or lat < -90 or lon > 180 or lon < -180:
-        abort(400)
-
-    requested_metrics = request.args.getlist('metrics', int)
-
-    if requested_metrics:
-        metric_ids = set(requested_metrics)
-    else:
-        metric_ids = Metric.query.with_entities(Metric.id)
-
     now = datetime.now(pytz.UTC)
-    start = request.args.get('start', type=int)
-    end = request.args.get('end', type=int)
 
     if start is None:
         start = now - timedelta(hours=1)
@@ -179,38 +168,133 @@ def wx_for_location():
             if end > now + timedelta(days=7):
                 end = now + timedelta(days=7)
 
-    requested_source_fields = SourceField.query.filter(
+    return start, end
+
+
+def get_wx_source_fields(requested_metrics):
+    if requested_metrics:
+        metric_ids = set(requested_metrics)
+    else:
+        metric_ids = Metric.query.with_entities(Metric.id)
+
+    return SourceField.query.filter(
         SourceField.metric_id.in_(metric_ids),
         SourceField.projection_id != None,  # noqa: E711
     ).all()
 
-    with tracing.start_span("load_data_points") as span:
-        span.set_attribute("start", str(start))
-        span.set_attribute("end", str(end))
-        span.set_attribute("source_fields", str(requested_source_fields))
-        data_points = load_data_points((lat, lon), start, end, requested_source_fields)
 
+def serialize_wx(data_points: DataPointBatch):
     # valid time -> data points
     datas = collections.defaultdict(list)
 
-    for dp in data_points:
-        datas[datetime2unix(dp.valid_time)].append({
-            'run_time': datetime2unix(dp.run_time),
-            'src_field_id': dp.source_field_id,
-            'value': dp.median(),
-            'raw_values': dp.values,
+    valid_times = data_points.valid_time.astype('datetime64[s]').astype(numpy.int64).tolist()
+    run_times = data_points.run_time.astype('datetime64[s]')
+    medians = data_points.median().tolist()
+
+    source_field_ids = data_points.source_field_id.tolist()
+
+    for i, (valid_time, run_time) in enumerate(zip(valid_times, run_times)):
+        datas[valid_time].append({
+            'run_time': int(run_time.astype(numpy.int64)) if not numpy.isnat(run_time) else None,
+            'src_field_id': source_field_ids[i] if source_field_ids[i] != -1 else None,
+            'value': medians[i],
+            'raw_values': data_points.point_values(i).tolist(),
         })
 
-    wx = {
+    return {
         'data': datas,
         'ordered_times': sorted(datas.keys()),
     }
 
-    return jsonify(wx)
+
+@api.route('/wx')
+async def wx_for_location():
+    """
+    Gets the weather for a specific location, optionally limiting by metric and time.
+    at that time.
+    """
+    lat = float(request.args['lat'])
+    lon = float(request.args['lon'])
+
+    if lat > 90 or lat < -90 or lon > 180 or lon < -180:
+        abort(400)
+
+    start, end = get_wx_time_range(request.args.get('start', type=int), request.args.get('end', type=int))
+    requested_source_fields = await run_db_async(get_wx_source_fields, request.args.getlist('metrics', int))
+
+    with tracing.start_span("load_data_points") as span:
+        span.set_attribute("start", str(start))
+        span.set_attribute("end", str(end))
+        span.set_attribute("source_fields", str(requested_source_fields))
+        data_points = await load_data_points_async((lat, lon), start, end, requested_source_fields)
+
+    return jsonify(serialize_wx(data_points))
+
+
+@api.route('/wx/batch', methods=['POST'])
+async def wx_for_locations():
+    """
+    Gets the weather for many locations at once.
+    Takes a JSON body of the form {"locations": [{"lat": ..., "lon": ...}, ...], "metrics": [...], "start": ..., "end": ...}
+    where everything but locations is optional and behaves the same as in /wx.
+    :return: List of wx results (same as /wx), one per requested location.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('locations'), list):
+        abort(400)
+
+    if len(body['locations']) > MAX_BATCH_LOCATIONS:
+        abort(400)
+
+    coords_list = []
+    for loc in body['locations']:
+        try:
+            lat = float(loc['lat'])
+            lon = float(loc['lon'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+
+        if lat > 90 or lat < -90 or lon > 180 or lon < -180:
+            abort(400)
+
+        coords_list.append((lat, lon))
+
+    try:
+        start = int(body['start']) if body.get('start') is not None else None
+        end = int(body['end']) if body.get('end') is not None else None
+        requested_metrics = [int(m) for m in body.get('metrics', [])]
+    except (TypeError, ValueError):
+        abort(400)
+
+    start, end = get_wx_time_range(start, end)
+    requested_source_fields = await run_db_async(get_wx_source_fields, requested_metrics)
+
+    with tracing.start_span("load_data_points_many") as span:
+        span.set_attribute("start", str(start))
+        span.set_attribute("end", str(end))
+        span.set_attribute("num_locations", len(coords_list))
+        span.set_attribute("source_fields", str(requested_source_fields))
+        loc_data_points = await load_data_points_many_async(coords_list, start, end, requested_source_fields)
+
+    return jsonify([serialize_wx(data_points) for data_points in loc_data_points])
+
+
+def get_summarize_source_fields():
+    return SourceField.query.filter(
+        or_(
+            SourceField.metric == metrics.temp,
+            SourceField.metric == metrics.raining,
+            SourceField.metric == metrics.snowing,
+            SourceField.metric_id.in_([metrics.wind_speed.id, metrics.wind_direction.id, metrics.gust_speed.id]),
+            SourceField.metric == metrics.cloud_cover,
+            SourceField.metric == metrics.composite_reflectivity,
+        ),
+        SourceField.projection_id != None,
+    ).all()
 
 
 @api.route('/wx/summarize')
-def summarize():
+async def summarize():
     """
     Summarizes the weather in a natural way.
     Returns a list of objects describing a summary of the weather (one per day).
@@ -237,24 +321,14 @@ def summarize():
             if start < now - timedelta(days=1):
                 start = now - timedelta(days=1)
 
-    source_fields = SourceField.query.filter(
-        or_(
-            SourceField.metric == metrics.temp,
-            SourceField.metric == metrics.raining,
-            SourceField.metric == metrics.snowing,
-            SourceField.metric_id.in_([metrics.wind_speed.id, metrics.wind_direction.id, metrics.gust_speed.id]),
-            SourceField.metric == metrics.cloud_cover,
-            SourceField.metric == metrics.composite_reflectivity,
-        ),
-        SourceField.projection_id != None,
-    ).all()
+    source_fields = await run_db_async(get_summarize_source_fields)
 
     with tracing.start_span("load_data_points") as span:
         end = start + timedelta(days=days)
         span.set_attribute("start", str(start))
         span.set_attribute("end", str(end))
         span.set_attribute("source_fields", str(source_fields))
-        data_points = load_data_points((lat, lon), start, end, source_fields)
+        data_points = await load_data_points_async((lat, lon), start, end, source_fields)
 
     with tracing.start_span("combine_models") as span:
         combined_data_points = combine_models(data_points)